@@ -0,0 +1,573 @@
+"""Offline measurements for the chat brain's speed/quality knobs.
+
+Loads the brain from data/brain.sqlite (or --db) and reports numbers to
+stdout, so tuning constants in brain.py can be decided with evidence.
+
+Usage:
+    ./.venv/bin/python src/ai/bench_brain.py ann                  # IVF recall@40 per probe count
+    ./.venv/bin/python src/ai/bench_brain.py ann --queries 2000
+    ./.venv/bin/python src/ai/bench_brain.py normalize            # memoized text layer, per call
+    ./.venv/bin/python src/ai/bench_brain.py scoring              # vectorized vs scalar scorer
+    ./.venv/bin/python src/ai/bench_brain.py consensus            # exact and graph vs dense cosine
+    ./.venv/bin/python src/ai/bench_brain.py memory               # float64 vs compact float32 fit
+    ./.venv/bin/python src/ai/bench_brain.py features             # n-gram vocabulary vs hashed space
+    ./.venv/bin/python src/ai/bench_brain.py markov               # array tables vs dict-of-lists
+    ./.venv/bin/python src/ai/bench_brain.py build                # cold build time per worker count
+    ./.venv/bin/python src/ai/bench_brain.py build --workers 1,4
+    ./.venv/bin/python src/ai/bench_brain.py batch                # reply() one by one vs reply_batch()
+    ./.venv/bin/python src/ai/bench_brain.py shards               # lookup latency/parity per shard count
+    ./.venv/bin/python src/ai/bench_brain.py shards --shards 1,2,4
+"""
+import gc
+import os
+import sys
+import math
+import pickle
+import random
+import time
+import sqlite3
+import argparse
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import brain  # noqa: E402
+
+PROBE_STEPS = (1, 2, 4, 8, 16, 32, 64)
+LIMIT_STEPS = (40, 100, 200, 400)
+
+
+def _sample_messages(db_path: str, n: int, seed: int = 7) -> list:
+    # real chat lines are the closest thing we have to live mentions
+    conn = sqlite3.connect(db_path)
+    rows = [r[0] for r in conn.execute("SELECT content FROM messages WHERE content != ''")]
+    conn.close()
+    random.Random(seed).shuffle(rows)
+    return rows[:n]
+
+
+# --- scalar reference paths ------------------------------------------------
+# What brain.py computed per request before candidates became one
+# CandidateSet: a dict per candidate, the dense n x n reply consensus and
+# the one-candidate-at-a-time scoring formula. The benches check the live
+# paths against these.
+
+
+def _token_overlap(query: dict, ids: list) -> float:
+    # Jaccard; input tokens unknown to the vocabulary still count towards the union
+    if not query["n_tokens"] or not ids:
+        return 0.0
+    known = set(query["token_array"].tolist())
+    inter = sum(1 for t in ids if t in known)
+    return inter / (query["n_tokens"] + len(ids) - inter)
+
+
+def _feature_row(r: brain.CorpusRetriever, i: int) -> dict:
+    n_main = len(r.features)
+    f, i = (r.features, i) if i < n_main else (r.delta_features, i - n_main)
+    return {
+        "reply_len": int(f.reply_len[i]),
+        "parent_question": bool(f.parent_question[i]),
+        "reply_generic": bool(f.reply_generic[i]),
+        "parent_tokens": f.parent_ids[f.parent_ptr[i]:f.parent_ptr[i + 1]].tolist(),
+        "reply_tokens": f.reply_ids[f.reply_ptr[i]:f.reply_ptr[i + 1]].tolist(),
+    }
+
+
+def _top_candidates(r: brain.CorpusRetriever, text: str, context=None, limit: int = 30) -> list:
+    if r.vectorizer is None or r.matrix is None:
+        return []
+    queries, weights = r._query_variants(text, context)
+    if not queries:
+        return []
+    ids, sims = r._rank(queries, weights, limit)
+    return [{
+        "idx": i,
+        "parent": r.keys[i],
+        "reply": r.replies[i],
+        "reply_norm": r.reply_norm(i),
+        "sim": sim,
+        "freq": int(r.reply_freq[r.reply_ids[i]]),
+        **_feature_row(r, i),
+    } for i, sim in zip(ids.tolist(), sims.tolist())]
+
+
+def _reply_consensus(r: brain.CorpusRetriever, cands: list) -> np.ndarray:
+    # similarity-weighted agreement of each candidate's reply with the rest
+    if not cands:
+        return np.zeros(0)
+    weights = np.array([c["sim"] for c in cands])
+    if r.reply_matrix is None:
+        # exact-duplicate agreement only
+        support = defaultdict(float)
+        for c in cands:
+            support[c["reply_norm"]] += c["sim"]
+        return np.array([support[c["reply_norm"]] for c in cands])
+    rows = r._reply_rows(r.reply_ids[np.array([c["idx"] for c in cands])])
+    return brain.cosine_similarity(rows).dot(weights)
+
+
+def _score_candidate(bot: brain.HopfiBrain, inp: str, cand: dict, query: dict) -> float:
+    score = cand["sim"] * 3.1
+    score -= math.log1p(cand["freq"]) * 0.15
+    if cand["reply_norm"] in bot._recent_norm:
+        score -= 2.0
+    parent_overlap = _token_overlap(query, cand["parent_tokens"])
+    score += parent_overlap * 1.10
+    reply_overlap = _token_overlap(query, cand["reply_tokens"])
+    score += reply_overlap * 0.18
+    if reply_overlap > 0.75:
+        score -= 0.9
+    if cand["reply_generic"]:
+        score -= 0.85
+    in_len = query["len"]
+    out_len = cand["reply_len"]
+    if query["question"] and cand["parent_question"]:
+        score += 0.25
+    if query["question"] and out_len <= 1:
+        score -= 0.30
+    if in_len <= 3 and out_len > 10:
+        score -= 0.55
+    if in_len >= 8 and out_len <= 1:
+        score -= 0.45
+    if out_len >= 28:
+        score -= 0.35
+    return score
+
+
+def cmd_ann(bot: brain.HopfiBrain, args):
+    r = bot.retriever
+    if r.lsa_index is None:
+        print(f"no LSA index (needs LSA and >= {brain.LSA_ANN_MIN_ROWS} pairs); the exact pass is used")
+        return
+    queries = _sample_messages(args.db, args.queries)
+    print(f"{len(r.keys)} pairs, {r.lsa_index.cells} cells, k={args.k}")
+    print(f"{'probes':>6} {'recall':>8} {'exact ms':>9} {'ivf ms':>8} {'queries':>8}")
+    for probes in PROBE_STEPS:
+        if probes > r.lsa_index.cells:
+            break
+        recall, exact_ms, approx_ms, used = r.lsa_recall(queries, k=args.k, probes=probes)
+        mark = "  <- LSA_PROBES" if probes == brain.LSA_PROBES else ""
+        print(f"{probes:>6} {recall:>8.3f} {exact_ms:>9.2f} {approx_ms:>8.2f} {used:>8}{mark}")
+
+
+def _per_call_us(fn, texts) -> float:
+    t0 = time.perf_counter()
+    for t in texts:
+        fn(t)
+    return (time.perf_counter() - t0) * 1e6 / max(1, len(texts))
+
+
+def cmd_normalize(bot: brain.HopfiBrain, args):
+    texts = _sample_messages(args.db, args.texts)
+    caches = (brain.normalize, brain.canon, brain.canon_tokens, brain._canon_token_set)
+    funcs = [
+        ("normalize", brain.normalize),
+        ("canon", brain.canon),
+        ("canon_tokens", brain.canon_tokens),
+        ("is_question", brain.is_question),
+        ("looks_generic", brain.looks_generic),
+        ("looks_uncertain", brain.looks_uncertain_reply),
+    ]
+    print(f"{len(texts)} distinct chat lines, cache size {brain.TEXT_CACHE_SIZE}")
+    print(f"{'function':<16} {'cold us':>8} {'memo us':>8} {'speedup':>8}")
+    for name, fn in funcs:
+        for c in caches:
+            c.cache_clear()
+        cold = _per_call_us(fn, texts)   # every call misses
+        warm = _per_call_us(fn, texts)   # every call hits
+        print(f"{name:<16} {cold:>8.2f} {warm:>8.2f} {cold / max(warm, 1e-9):>7.1f}x")
+
+
+def cmd_scoring(bot: brain.HopfiBrain, args):
+    r = bot.retriever
+    queries = _sample_messages(args.db, args.queries)
+    print(f"{len(queries)} queries, CANDIDATE_LIMIT={brain.CANDIDATE_LIMIT}")
+    print(f"{'limit':>6} {'cands':>7} {'scalar us':>10} {'vector us':>10} {'speedup':>8} {'mismatch':>9}")
+    for limit in LIMIT_STEPS:
+        scalar = vector = 0.0
+        n = bad = 0
+        for q in queries:
+            cands = r.lookup(q, limit=limit)
+            if cands is None:
+                continue
+            dicts = _top_candidates(r, q, limit=limit)
+            # the live consensus, so only the scoring formula is compared
+            consensus = r._consensus(np.array([c["idx"] for c in dicts]), np.array([c["sim"] for c in dicts]))
+            query = r.query_features(q)
+            t0 = time.perf_counter()
+            ref = [
+                _score_candidate(bot, q, c, query) + brain.CONSENSUS_WEIGHT * math.log1p(max(0.0, consensus[k]))
+                for k, c in enumerate(dicts)
+            ]
+            t1 = time.perf_counter()
+            got = bot._score_candidates(q, cands, query)
+            t2 = time.perf_counter()
+            scalar += t1 - t0
+            vector += t2 - t1
+            n += len(ref)
+            bad += sum(a != b for a, b in zip(ref, got.tolist()))
+        calls = max(1, len(queries))
+        print(f"{limit:>6} {n / calls:>7.1f} {scalar * 1e6 / calls:>10.1f} {vector * 1e6 / calls:>10.1f} "
+              f"{scalar / max(vector, 1e-9):>7.1f}x {bad:>9}")
+
+
+def cmd_consensus(bot: brain.HopfiBrain, args):
+    r = bot.retriever
+    if r.reply_matrix is None:
+        print("reply space disabled, consensus counts exact duplicates only")
+        return
+    queries = _sample_messages(args.db, args.queries)
+    hits = [(c, np.array([x["idx"] for x in c]), np.array([x["sim"] for x in c]))
+            for c in (_top_candidates(r, q, limit=brain.CANDIDATE_LIMIT) for q in queries) if c]
+
+    def run(label):
+        elapsed = 0.0
+        worst = shift = 0.0
+        for cands, idxs, weights in hits:
+            ref = _reply_consensus(r, cands)
+            t0 = time.perf_counter()
+            got = r._consensus(idxs, weights)
+            elapsed += time.perf_counter() - t0
+            worst = max(worst, float(np.abs(ref - got).max()))
+            shift += np.abs(np.log1p(ref) - np.log1p(got)).mean() * brain.CONSENSUS_WEIGHT
+        n = max(1, len(hits))
+        print(f"{label:<8} {elapsed * 1e6 / n:>8.1f} us  max diff {worst:.3g}  mean score shift {shift / n:.4f}")
+        return worst
+
+    graph = r.reply_graph
+    try:
+        # exact per-request consensus, whatever the index was built with
+        r.reply_graph = None
+        worst = run("exact")
+        t0 = time.perf_counter()
+        r.reply_graph = brain.ReplyGraph.build(brain.l2_normalize(r.reply_matrix), k=args.k)
+        build_s = time.perf_counter() - t0
+        print(f"graph k={args.k}: {r.reply_graph.edges.nnz / max(1, r.reply_graph.nodes):.1f} edges/reply, "
+              f"build {build_s:.2f}s")
+        run("graph")
+    finally:
+        r.reply_graph = graph
+    if worst > args.tolerance:
+        print(f"exact consensus off the dense cosine by {worst:.3g} > {args.tolerance:g}")
+        return 1
+
+
+def _load_pairs(db_path: str):
+    # same selection HopfiBrain._load trains on
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT parentKey, reply FROM pairs WHERE parentKey != '' AND reply != ''").fetchall()
+    conn.close()
+    rows = [(k, r) for k, r in rows if not brain.looks_spam(r) and not brain.looks_spam(k)]
+    return [k for k, _ in rows], [r for _, r in rows]
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return float("nan")
+
+
+def _nbytes(obj) -> int:
+    if obj is None:
+        return 0
+    if hasattr(obj, "indptr"):
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    return np.asarray(obj).nbytes
+
+
+def _retriever_sizes(r: brain.CorpusRetriever) -> dict:
+    return {
+        "matrix": _nbytes(r.matrix),
+        "postings": _nbytes(r.postings) + _nbytes(r.row_norms),
+        "reply_matrix": _nbytes(r.reply_matrix),
+        "reply_graph": _nbytes(r.reply_graph and r.reply_graph.edges),
+        "lsa_matrix": _nbytes(r.lsa_matrix),
+        "svd": _nbytes(r.svd and r.svd.components_),
+        "lsa_index": 0 if r.lsa_index is None else _nbytes(r.lsa_index.centroids) + _nbytes(r.lsa_index.cell_rows),
+        "strings": r.keys.nbytes + r.replies.nbytes + r.reply_vocab.nbytes,
+    }
+
+
+def _str_list_bytes(strings) -> int:
+    # what the same rows cost as list[str]
+    items = list(strings)
+    return sys.getsizeof(items) + sum(sys.getsizeof(s) for s in items)
+
+
+def cmd_memory(bot: brain.HopfiBrain, args):
+    keys, replies = _load_pairs(args.db)
+    queries = _sample_messages(args.db, args.queries)
+    modes = {}
+    configured = brain.COMPACT_MATRICES
+    for compact in (False, True):
+        brain.COMPACT_MATRICES = compact
+        gc.collect()
+        rss0 = _rss_mb()
+        t0 = time.perf_counter()
+        r = brain.CorpusRetriever()
+        r.train(keys, replies)
+        fit_s = time.perf_counter() - t0
+        gc.collect()
+        hits = {q: _top_candidates(r, q, limit=brain.CANDIDATE_LIMIT) for q in queries}
+        modes[compact] = (_retriever_sizes(r), _rss_mb() - rss0, fit_s, hits)
+        as_lists = sum(_str_list_bytes(a) for a in (r.keys, r.replies, r.reply_vocab))
+        del r
+    brain.COMPACT_MATRICES = configured
+    (wide, wide_rss, wide_s, wide_hits), (slim, slim_rss, slim_s, slim_hits) = modes[False], modes[True]
+    print(f"{len(keys)} pairs")
+    print(f"{'':<14} {'float64 MB':>11} {'compact MB':>11}")
+    for name in wide:
+        print(f"{name:<14} {wide[name] / 2**20:>11.1f} {slim[name] / 2**20:>11.1f}")
+    print(f"{'total':<14} {sum(wide.values()) / 2**20:>11.1f} {sum(slim.values()) / 2**20:>11.1f}")
+    print(f"{'rss growth':<14} {wide_rss:>11.1f} {slim_rss:>11.1f}")
+    print(f"{'fit seconds':<14} {wide_s:>11.1f} {slim_s:>11.1f}")
+    print(f"strings as list[str] would be {as_lists / 2**20:.1f} MB")
+    # parity: same candidates, same order, similarities within float32 error
+    same_top = overlap = n = 0
+    drift = 0.0
+    for q in queries:
+        a, b = wide_hits[q], slim_hits[q]
+        if not a and not b:
+            continue
+        n += 1
+        same_top += bool(a and b and a[0]["idx"] == b[0]["idx"])
+        ids_a, ids_b = {c["idx"]: c["sim"] for c in a}, {c["idx"]: c["sim"] for c in b}
+        overlap += len(ids_a.keys() & ids_b.keys()) / max(1, len(ids_a.keys() | ids_b.keys()))
+        drift = max([drift] + [abs(ids_a[i] - ids_b[i]) for i in ids_a.keys() & ids_b.keys()])
+    n = max(1, n)
+    print(f"parity over {n} queries: top-1 same {same_top / n:.3f}, "
+          f"top-{brain.CANDIDATE_LIMIT} overlap {overlap / n:.3f}, max sim drift {drift:.2e}")
+
+
+def cmd_features(bot: brain.HopfiBrain, args):
+    keys, replies = _load_pairs(args.db)
+    queries = _sample_messages(args.db, args.queries)
+    print(f"{len(keys)} pairs, {args.buckets} buckets per analyzer")
+    print(f"{'mode':<8} {'fit s':>7} {'columns':>9} {'lsa cols':>9} {'pickle MB':>10} {'unpickle ms':>12} {'top-1 same':>11} {'overlap':>8}")
+    base = None
+    for mode in ("vocab", "hashed"):
+        t0 = time.perf_counter()
+        r = brain.CorpusRetriever(feature_mode=mode, hash_buckets=args.buckets)
+        r.train(keys, replies)
+        fit_s = time.perf_counter() - t0
+        blob = pickle.dumps((r.vectorizer, r.reply_vectorizer), protocol=pickle.HIGHEST_PROTOCOL)
+        t0 = time.perf_counter()
+        pickle.loads(blob)
+        unpickle_ms = (time.perf_counter() - t0) * 1e3
+        hits = {q: [c["idx"] for c in _top_candidates(r, q, limit=brain.CANDIDATE_LIMIT)] for q in queries}
+        if base is None:
+            base = hits
+        same = [bool(a and b and a[0] == b[0]) for a, b in ((base[q], hits[q]) for q in queries) if a or b]
+        overlap = [len(set(base[q]) & set(hits[q])) / max(1, len(set(base[q]) | set(hits[q])))
+                   for q in queries if base[q] or hits[q]]
+        lsa_cols = r.svd.components_.shape[1] if r.svd is not None else 0
+        print(f"{mode:<8} {fit_s:>7.1f} {r.matrix.shape[1]:>9} {lsa_cols:>9} {len(blob) / 2**20:>10.2f} "
+              f"{unpickle_ms:>12.1f} {np.mean(same) if same else 0:>11.3f} {np.mean(overlap) if overlap else 0:>8.3f}")
+        del r
+
+
+def cmd_build(bot: brain.HopfiBrain, args):
+    counts = [int(w) for w in args.workers.split(",")] if args.workers else [1, os.cpu_count() or 1]
+    queries = _sample_messages(args.db, args.queries)
+    print(f"cold build (no snapshot) of {args.db}, {os.cpu_count()} cores")
+    print(f"{'workers':>7} {'load s':>7} {'speedup':>8} {'same top-40':>12}")
+    base = base_s = None
+    for workers in counts:
+        brain.BUILD_WORKERS = workers
+        brain.normalize.cache_clear()
+        brain.canon.cache_clear()
+        gc.collect()
+        t0 = time.perf_counter()
+        b = brain.HopfiBrain(args.db, index_dir=None)
+        load_s = time.perf_counter() - t0
+        hits = {q: [c["idx"] for c in _top_candidates(b.retriever, q, limit=brain.CANDIDATE_LIMIT)] for q in queries}
+        if base is None:
+            base, base_s = hits, load_s
+        same = np.mean([base[q] == hits[q] for q in queries]) if queries else 1.0
+        print(f"{workers:>7} {load_s:>7.1f} {base_s / load_s:>7.2f}x {same:>12.3f}")
+        del b
+
+
+def cmd_batch(bot: brain.HopfiBrain, args):
+    texts = _sample_messages(args.db, args.requests)
+    # every other request carries the two previous lines as context
+    requests = [(t, texts[max(0, i - 2):i][::-1] if i % 2 else []) for i, t in enumerate(texts)]
+    recent = (bot._recent_norm.hashes(), list(bot._recent_raw))
+    print(f"{len(requests)} requests, bursts of {args.size}, cold retrieval cache")
+    print(f"{'mode':<10} {'total s':>8} {'req/s':>8} {'same replies':>13}")
+    base = None
+    for mode in ("reply", "batch"):
+        bot._recent_norm.reset(recent[0])
+        bot._recent_raw.clear()
+        bot._recent_raw.extend(recent[1])
+        bot.retriever.cache.clear()
+        random.seed(1)
+        t0 = time.perf_counter()
+        out = []
+        for lo in range(0, len(requests), args.size):
+            burst = requests[lo:lo + args.size]
+            if mode == "batch":
+                out += bot.reply_batch(burst)
+            else:
+                out += [bot.reply(t, context=c) for t, c in burst]
+        secs = time.perf_counter() - t0
+        if base is None:
+            base = out
+        same = np.mean([a == b for a, b in zip(base, out)]) if out else 1.0
+        print(f"{mode:<10} {secs:>8.2f} {len(out) / secs:>8.0f} {same:>13.3f}")
+
+
+def cmd_shards(bot: brain.HopfiBrain, args):
+    r = bot.retriever
+    counts = [int(k) for k in args.shards.split(",")] if args.shards else [1, 2, os.cpu_count() or 1]
+    queries = _sample_messages(args.db, args.queries)
+    print(f"single-query lookups over {r.matrix.shape[0]} rows, {os.cpu_count()} cores, cold retrieval cache")
+    print(f"{'shards':>6} {'start s':>8} {'p50 ms':>7} {'p95 ms':>7} {'same top-40':>12}")
+    base = None
+    for count in counts:
+        t0 = time.perf_counter()
+        r.start_shards(count)
+        start_s = time.perf_counter() - t0
+        r.cache.clear()
+        times, hits = [], {}
+        for q in queries:
+            t0 = time.perf_counter()
+            cands = r.lookup(q, limit=brain.CANDIDATE_LIMIT)
+            times.append(time.perf_counter() - t0)
+            hits[q] = [] if cands is None else cands.idx.tolist()
+        if base is None:
+            base = hits
+        same = np.mean([base[q] == hits[q] for q in queries]) if queries else 1.0
+        p50, p95 = np.percentile(times, [50, 95]) * 1000 if times else (0.0, 0.0)
+        print(f"{count:>6} {start_s:>8.1f} {p50:>7.2f} {p95:>7.2f} {same:>12.3f}")
+    if r.shards is not None:
+        # a shard that dies is restarted by the next lookup that hits it
+        r.shards.procs[0].kill()
+        r.shards.procs[0].join()
+        r.cache.clear()
+        t0 = time.perf_counter()
+        r.lookup(queries[0], limit=brain.CANDIDATE_LIMIT)
+        restart_s = time.perf_counter() - t0
+        hits = {q: [] if c is None else c.idx.tolist() for q in queries for c in [r.lookup(q, limit=brain.CANDIDATE_LIMIT)]}
+        same = np.mean([base[q] == hits[q] for q in queries]) if queries else 1.0
+        print(f"killed shard 0: first lookup {restart_s:.1f}s, still sharded: {r.shards is not None}, same top-40 {same:.3f}")
+    r.stop_shards()
+
+
+class _ListMarkov:
+    """The previous dict-of-lists MarkovBrain, kept as the baseline."""
+
+    def __init__(self):
+        self.trigrams = defaultdict(list)
+        self.bigrams = defaultdict(list)
+        self.starters = []
+
+    def train(self, messages):
+        for msg in messages:
+            words = brain.tokenize(msg)
+            if not words:
+                continue
+            self.starters.append(tuple(words[:2]))
+            for i in range(len(words)):
+                if i + 2 < len(words):
+                    self.trigrams[(words[i], words[i + 1])].append(words[i + 2])
+                if i + 1 < len(words):
+                    self.bigrams[words[i]].append(words[i + 1])
+
+    def generate(self, seed: str = "", max_words: int = 20) -> str:
+        words = brain.tokenize(seed)
+        if len(words) >= 2 and (words[-2], words[-1]) in self.trigrams:
+            result = [words[-2], words[-1]]
+        elif words and words[-1] in self.bigrams:
+            result = [words[-1]]
+        elif self.starters:
+            result = list(random.choice(self.starters))
+        else:
+            return ""
+        while len(result) < max_words:
+            if len(result) >= 2 and (result[-2], result[-1]) in self.trigrams:
+                nxt = random.choice(self.trigrams[(result[-2], result[-1])])
+            elif result[-1] in self.bigrams:
+                nxt = random.choice(self.bigrams[result[-1]])
+            else:
+                break
+            if len(result) >= 3 and nxt == result[-1] == result[-2]:
+                break
+            result.append(nxt)
+            if len(result) >= 5 and random.random() < 0.22:
+                break
+        return " ".join(result).strip()
+
+
+def cmd_markov(bot: brain.HopfiBrain, args):
+    conn = sqlite3.connect(args.db)
+    messages = [r[0] for r in conn.execute("SELECT content FROM messages WHERE content != ''")]
+    conn.close()
+    seeds = _sample_messages(args.db, args.calls)
+    print(f"{len(messages)} messages, {len(seeds)} generate() calls")
+    print(f"{'engine':<12} {'train s':>8} {'held MB':>8} {'peak MB':>8} {'gen us':>8}")
+    for name, cls in (("dict-lists", _ListMarkov), ("arrays", brain.MarkovBrain)):
+        brain.normalize.cache_clear()
+        gc.collect()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        m = cls()
+        m.train(messages)
+        train_s = time.perf_counter() - t0
+        brain.normalize.cache_clear()
+        gc.collect()
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        random.seed(1)
+        t0 = time.perf_counter()
+        for seed in seeds:
+            m.generate(seed=seed, max_words=12)
+        gen_us = (time.perf_counter() - t0) * 1e6 / max(1, len(seeds))
+        print(f"{name:<12} {train_s:>8.2f} {held / 2**20:>8.1f} {peak / 2**20:>8.1f} {gen_us:>8.1f}")
+        del m
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", default=brain.DB_PATH)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ann = sub.add_parser("ann", help="recall@k of the IVF LSA index vs the exact pass")
+    ann.add_argument("--queries", type=int, default=500)
+    ann.add_argument("-k", type=int, default=40)
+    norm = sub.add_parser("normalize", help="per-call cost of the text layer, cold vs memoized")
+    norm.add_argument("--texts", type=int, default=5000)
+    scoring = sub.add_parser("scoring", help="candidate scoring per request, scalar vs vectorized")
+    scoring.add_argument("--queries", type=int, default=300)
+    cons = sub.add_parser("consensus", help="consensus vs the dense n x n cosine, exact and kNN graph")
+    cons.add_argument("--queries", type=int, default=300)
+    cons.add_argument("-k", type=int, default=brain.REPLY_GRAPH_K or 64, help="neighbours per reply in the graph")
+    cons.add_argument("--tolerance", type=float, default=1e-9, help="fail when exact consensus is further off")
+    mem = sub.add_parser("memory", help="fitted size and retrieval parity, float64 vs compact")
+    mem.add_argument("--queries", type=int, default=300)
+    feats = sub.add_parser("features", help="vocabulary vs hashed feature space: size, load time, parity")
+    feats.add_argument("--queries", type=int, default=300)
+    feats.add_argument("--buckets", type=int, default=brain.HASH_BUCKETS)
+    markov = sub.add_parser("markov", help="markov tables: memory, train and generate time")
+    markov.add_argument("--calls", type=int, default=2000)
+    build = sub.add_parser("build", help="cold build wall time by worker count")
+    build.add_argument("--workers", default="", help="comma-separated counts (default: 1 and one per core)")
+    build.add_argument("--queries", type=int, default=200)
+    batch = sub.add_parser("batch", help="reply() one by one vs reply_batch() over bursts")
+    batch.add_argument("--requests", type=int, default=1000)
+    batch.add_argument("--size", type=int, default=50, help="requests per burst")
+    shards = sub.add_parser("shards", help="single-lookup latency and parity by retrieval shard count")
+    shards.add_argument("--shards", default="", help="comma-separated counts (default: 1, 2 and one per core)")
+    shards.add_argument("--queries", type=int, default=500)
+    args = ap.parse_args()
+
+    bot = brain.HopfiBrain(args.db)
+    sys.exit({"ann": cmd_ann, "normalize": cmd_normalize, "scoring": cmd_scoring, "consensus": cmd_consensus, "memory": cmd_memory, "features": cmd_features, "markov": cmd_markov, "build": cmd_build, "batch": cmd_batch, "shards": cmd_shards}[args.cmd](bot, args))
+
+
+if __name__ == "__main__":
+    main()
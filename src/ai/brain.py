@@ -2,16 +2,34 @@ import re
 import sys
 import json
 import math
+import copy
+import pickle
 import random
+import shutil
+import tempfile
+import hashlib
 import sqlite3
+import signal
+import asyncio
+import argparse
+import threading
+import time
 import os
-from collections import defaultdict, deque, Counter
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from array import array
+from urllib.request import pathname2url
+from collections import deque, Counter, OrderedDict
 from difflib import get_close_matches
-from typing import List, Optional, Dict, Tuple
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, Optional, Dict, Tuple
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.pipeline import FeatureUnion
+import sklearn
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import FeatureUnion, Pipeline
 from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import normalize as l2_normalize
 from sklearn.metrics.pairwise import cosine_similarity
@@ -23,6 +41,13 @@ from sklearn.metrics.pairwise import cosine_similarity
 _BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../data")
 DB_PATH = os.path.join(_BASE, "brain.sqlite")
 EMOJI_PATH = os.path.join(_BASE, "emojis.json")
+# Snapshot of the fitted retriever, reused on start/reload while the DB is
+# unchanged (matrices are memory-mapped instead of refitted). The markov
+# tables get their own next to it (INDEX_DIR + ".markov"), keyed by the
+# messages table.
+INDEX_DIR = os.path.join(_BASE, "ai", "index")
+# Bump whenever the snapshot layout changes; older snapshots are refitted.
+INDEX_FORMAT = 8
 
 # How much the latent-semantic (LSA) similarity may BOOST a candidate when
 # lexical retrieval is weak. LSA is a safety net, never the primary signal.
@@ -34,17 +59,117 @@ LSA_MIN_PAIRS = 50
 # If the best raw TF-IDF cosine reaches this, we have a confident lexical
 # match and skip LSA entirely (keeps exact greetings etc. pristine).
 LSA_LEXICAL_TRUST = 0.45
+# The LSA safety net searches an IVF index (k-means cells over lsa_matrix)
+# and only scores the rows in the LSA_PROBES cells nearest to the query.
+# More probes = closer to the exact dense pass (bench_brain.py ann reports
+# recall@40 per probe count); 0 always does the exact pass.
+LSA_PROBES = 16
+# Below this many pairs the exact pass is cheap enough; no index is built.
+LSA_ANN_MIN_ROWS = 5000
 
 # Below this best candidate score, retrieval is a miss -> fallback bucket.
 MIN_RELEVANT_SCORE = 0.30
 # Candidates within this score of the best are eligible for the weighted pick.
 # Having many near-best replies is GOOD (on-topic variety), not ambiguity.
 SHORTLIST_WINDOW = 0.60
+# How many retrieved candidates _pick scores per request. Scoring is
+# vectorized, so this can go to a few hundred without a latency hit.
+CANDIDATE_LIMIT = 40
 # Only consider mutating (markov-extending) a reply when we're not confident.
 MUTATE_BELOW_SCORE = 0.90
 # How strongly neighbor consensus counts: if many similar parents produced the
 # same reply, that agreement is a strong signal it's the right answer.
 CONSENSUS_WEIGHT = 0.85
+# By default consensus is the exact cosine between the candidates' replies,
+# computed per request over the distinct replies among them. REPLY_GRAPH_K > 0
+# reads it from a kNN graph built at fit time instead: every distinct reply
+# keeps its REPLY_GRAPH_K nearest replies with cosine >= REPLY_GRAPH_MIN_SIM.
+# That drops the weak and beyond-k pairs, so it moves scores (``bench_brain.py
+# consensus`` reports by how much); CONSENSUS_WEIGHT is tuned for exact.
+REPLY_GRAPH_K = 0
+REPLY_GRAPH_MIN_SIM = 0.20
+# The graph is built a block of rows at a time; a block's sparse product is
+# cut to about this many bytes (one block per build thread in flight).
+REPLY_GRAPH_BLOCK_BYTES = 64 * 2 ** 20
+
+# Fit every matrix (TF-IDF, reply space, LSA, SVD components) as float32
+# with int32 indices instead of float64. Roughly halves the resident size of
+# the largest objects in the process (the char n-gram matrix above all);
+# similarities move in the 7th digit, which can reorder near ties. Opt-in
+# (--compact) until ``bench_brain.py memory`` parity says otherwise.
+COMPACT_MATRICES = False
+# Feature backend of the key and reply spaces. "vocab" fits an n-gram
+# vocabulary (a Python dict entry per distinct n-gram, which for char 3-5
+# grams runs to hundreds of MB). "hashed" hashes n-grams into HASH_BUCKETS
+# columns per analyzer and keeps only an idf vector: fixed footprint,
+# nothing to pickle but the idf, and unseen n-grams count without a refit.
+FEATURE_MODE = "vocab"
+HASH_BUCKETS = 2 ** 18
+
+# Seconds between polls for pairs/messages learned since the last (re)load.
+# New rows go into a small delta segment (fixed feature space, no refit), so
+# they are retrievable long before the nightly full reload. 0 disables it.
+INGEST_INTERVAL = 5.0
+# Fold the delta segment into the main matrices once it holds this many rows.
+DELTA_COMPACT_ROWS = 2000
+
+# Full loads stream the DB in batches of this many rows (fetchmany) instead
+# of materializing whole tables, and map up to SQLITE_MMAP_SIZE bytes of it.
+LOAD_BATCH_ROWS = 5000
+SQLITE_MMAP_SIZE = 256 * 2 ** 20
+# Worker processes for a full build: row preprocessing, the four TF-IDF fits
+# (word/char x key/reply) and markov run concurrently, SVD and the reply
+# graph on threads. 0 = one per core, 1 = build serially in-process.
+BUILD_WORKERS = 0
+
+# serve() answers requests that carry an "id" on this many threads, tagged
+# with that id and in completion order. Replies still take the brain lock
+# one at a time, but nothing queues behind a slow one on the stdin reader.
+SERVE_THREADS = 4
+# --serve --workers N: pre-fork N serve processes from one loaded brain. They
+# share its matrices and string arenas (copy-on-write, or the page cache of
+# a mapped snapshot) and one anti-repeat window; the parent only dispatches.
+SERVE_WORKERS = 1
+# --listen unix:/path: each connection may have this many requests in flight
+# before the server stops reading from it (its answers still drain).
+LISTEN_MAX_INFLIGHT = 32
+# Longest request line (a big batch) a connection may send.
+LISTEN_LINE_LIMIT = 16 * 2 ** 20
+# --shards K: split the main segment by row range over K processes, each
+# searching its rows for every query (scatter-gather), so one lookup uses K
+# cores. They hold copies of their rows; the dispatching process drops its
+# posting view and keeps the rows mapped from the snapshot (to restart a
+# shard that died, compact and save), so the index is resident about once.
+# Without a snapshot (no INDEX_DIR), or after a compaction, its rows stay
+# in memory. 1 = search in-process.
+RETRIEVAL_SHARDS = 1
+
+# Live markov updates are counted in small dicts and folded into the
+# array tables once this many continuations have piled up.
+MARKOV_MERGE_EVERY = 50000
+
+# Retrieval results (candidates + consensus) cached per canonical query and
+# context. Chat is repetitive ("servus", "wie gehts"), and the per-request
+# anti-repeat filtering and random pick still run on top of a cached hit.
+RETRIEVAL_CACHE_SIZE = 2048
+# Seconds a cached result may be served; 0 = until the next invalidation.
+RETRIEVAL_CACHE_TTL = 900
+
+# Per-stage reply latencies are kept in log-linear histograms with this
+# many buckets per power of two (~3% error), rolled every STATS_WINDOW
+# seconds: quantiles cover the current and the previous window.
+STATS_SUB_BUCKETS = 16
+STATS_WINDOW = 300
+# --stats-every N: dump the stats to stderr every N seconds; 0 = never.
+STATS_LOG_INTERVAL = 0
+# {"profile": {"seconds": N}} samples the stacks of the threads answering
+# requests every PROFILE_INTERVAL seconds and writes them (collapsed, one
+# "frame;frame;... count" line per stack, for flamegraph.pl / speedscope)
+# to PROFILE_DIR; the answer lists the PROFILE_TOP hottest functions.
+PROFILE_DIR = os.path.join(_BASE, "ai", "profiles")
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP = 15
 
 # Austrian / German dialect equivalence map. Applied ONLY to the matching
 # surfaces (vectorizer input + lexical overlap) so that dialect spelling
@@ -76,6 +201,14 @@ DIALECT_MAP: Dict[str, str] = {
 
 _DIALECT_PHRASES = {k: v for k, v in DIALECT_MAP.items() if " " in k}
 _DIALECT_TOKENS = {k: v for k, v in DIALECT_MAP.items() if " " not in k}
+# all multi-word phrases in one alternation (longest first), one pass
+_DIALECT_PHRASE_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(p) for p in sorted(_DIALECT_PHRASES, key=len, reverse=True)) + r")\b"
+) if _DIALECT_PHRASES else None
+
+# Bounded memo for normalize/canon/canon_tokens: one request re-normalizes
+# the same input and candidate strings dozens of times.
+TEXT_CACHE_SIZE = 65536
 
 # Question markers (German + Austrian).
 _QUESTION_WORDS = {
@@ -99,6 +232,12 @@ _UNCERTAIN_MARKERS = [
     "hmm", "wer waß", "wer weiss", "gute frage",
 ]
 
+_EMOJI_TOKEN_RE = re.compile(r":([A-Za-z0-9_]+):")
+_MENTION_RE = re.compile(r"<@!?\d+>")
+_CUSTOM_EMOJI_RE = re.compile(r"<a?:\w+:\d+>")
+_URL_RE = re.compile(r"https?://\S+")
+_SPACE_RE = re.compile(r"\s+")
+
 class EmojiResolver:
     def __init__(self, path: str = EMOJI_PATH):
         with open(path, encoding="utf-8") as f:
@@ -119,24 +258,26 @@ class EmojiResolver:
                 return self._map[f":{close[0]}:"]
             # no match - drop it
             return ""
-        return re.sub(r":([A-Za-z0-9_]+):", replace, text).strip()
+        return _EMOJI_TOKEN_RE.sub(replace, text).strip()
 
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
 def normalize(text: str) -> str:
     text = (text or "").lower().strip()      # lowercase and trim
-    text = re.sub(r"<@!?\d+>", "", text)     # remove Discord mentions
-    text = re.sub(r"<a?:\w+:\d+>", "", text)  # remove custom emojis
-    text = re.sub(r"https?://\S+", "", text)  # remove URLs
-    text = re.sub(r"\s+", " ", text).strip()  # collapse whitespace
+    text = _MENTION_RE.sub("", text)         # remove Discord mentions
+    text = _CUSTOM_EMOJI_RE.sub("", text)    # remove custom emojis
+    text = _URL_RE.sub("", text)             # remove URLs
+    text = _SPACE_RE.sub(" ", text).strip()  # collapse whitespace
     return text
 
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
 def canon(text: str) -> str:
     """Normalize + collapse Austrian dialect variants for MATCHING only."""
     t = normalize(text)
     if not t:
         return t
     # multi-word dialect phrases first
-    for phrase, repl in _DIALECT_PHRASES.items():
-        t = re.sub(rf"\b{re.escape(phrase)}\b", repl, t)
+    if _DIALECT_PHRASE_RE is not None:
+        t = _DIALECT_PHRASE_RE.sub(lambda m: _DIALECT_PHRASES[m.group(0)], t)
     toks = t.split()
     return " ".join(_DIALECT_TOKENS.get(tok, tok) for tok in toks)
 
@@ -144,16 +285,22 @@ def tokenize(text: str) -> List[str]:
     """Raw tokens (no dialect collapse) - used for length/quality checks."""
     return normalize(text).split()
 
-def canon_tokens(text: str) -> List[str]:
-    return canon(text).split()
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def canon_tokens(text: str) -> Tuple[str, ...]:
+    # memoized, hence an immutable tuple
+    return tuple(canon(text).split())
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _canon_token_set(text: str) -> frozenset:
+    return frozenset(canon_tokens(text))
 
 def is_question(text: str) -> bool:
-    words = set(canon(text).split())
+    words = _canon_token_set(text)
     return "?" in (text or "") or any(w in words for w in _QUESTION_WORDS)
 
 def lexical_overlap(a: str, b: str) -> float:
-    aa = set(canon_tokens(a))
-    bb = set(canon_tokens(b))
+    aa = _canon_token_set(a)
+    bb = _canon_token_set(b)
     if not aa or not bb:
         return 0.0
     return len(aa & bb) / len(aa | bb)
@@ -182,157 +329,1383 @@ def looks_spam(text: str) -> bool:
         return True
     return bool(_SPAM_RE.search(text or ""))
 
+# the markers in canonical form, as one substring matcher
+_UNCERTAIN_RE = re.compile("|".join(re.escape(canon(m)) for m in _UNCERTAIN_MARKERS))
+
 def looks_uncertain_reply(text: str) -> bool:
     t = canon(text)
     if not t:
         return False
-    return any(m in t for m in (canon(m) for m in _UNCERTAIN_MARKERS))
+    return _UNCERTAIN_RE.search(t) is not None
+
+def reply_quality_ok(text: str) -> bool:
+    nt = normalize(text)
+    toks = tokenize(nt)
+    if not nt:
+        return False
+    if looks_spam(text):
+        return False
+    if len(toks) < 1 or len(toks) > 18:
+        return False
+    counts = Counter(toks)
+    if max(counts.values(), default=0) >= 3:
+        return False
+    if len(toks) >= 4 and len(set(toks)) / max(1, len(toks)) < 0.40:
+        return False
+    one_char = sum(1 for t in toks if len(t) == 1)
+    if one_char >= max(3, len(toks) // 2):
+        return False
+    for i in range(len(toks) - 2):
+        if toks[i] == toks[i + 1] == toks[i + 2]:
+            return False
+    return True
+
+def fallback_worthy(reply: str) -> bool:
+    return reply_quality_ok(reply) and (
+        looks_uncertain_reply(reply) or looks_generic(reply) or len(tokenize(reply)) <= 5
+    )
+
+class SuccessorTable:
+    """Next-token counts per packed context key, as CSR-style arrays.
+
+    ``keys`` is sorted; the distinct successors of ``keys[i]`` are
+    ``next[ptr[i]:ptr[i + 1]]`` and ``cum`` holds their running counts.
+    Counts added after the build collect in a small ``pending`` dict until
+    ``merge`` folds them in.
+    """
+
+    __slots__ = ("keys", "ptr", "next", "cum", "pending", "pending_n")
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.ptr = np.zeros(1, dtype=np.int64)
+        self.next = np.zeros(0, dtype=np.int32)
+        self.cum = np.zeros(0, dtype=np.int64)
+        self.pending: Dict[int, Dict[int, int]] = {}
+        self.pending_n = 0
+
+    @classmethod
+    def build(cls, keys: np.ndarray, nxt: np.ndarray, counts: Optional[np.ndarray] = None) -> "SuccessorTable":
+        """Table of (key, next) observations, each seen ``counts`` times (once by default)."""
+        table = cls()
+        if keys.size == 0:
+            return table
+        counts = np.ones(keys.size, dtype=np.int64) if counts is None else counts
+        order = np.lexsort((nxt, keys))
+        keys, nxt, counts = keys[order], nxt[order], counts[order]
+        new_pair = np.concatenate([[True], (keys[1:] != keys[:-1]) | (nxt[1:] != nxt[:-1])])
+        starts = np.flatnonzero(new_pair)
+        pair_counts = np.add.reduceat(counts, starts)
+        pair_keys, pair_next = keys[starts], nxt[starts]
+        table.keys, first = np.unique(pair_keys, return_index=True)
+        table.ptr = np.concatenate([first, [pair_keys.size]]).astype(np.int64)
+        table.next = pair_next.astype(np.int32)
+        running = np.cumsum(pair_counts)
+        base = np.concatenate([[0], running])[table.ptr[:-1]]
+        table.cum = running - np.repeat(base, np.diff(table.ptr))
+        return table
+
+    def counts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(key, next, count) triplets of the built part."""
+        lens = np.diff(self.ptr)
+        seg_start = np.repeat(self.ptr[:-1], lens)
+        prev = np.where(np.arange(self.cum.size) > seg_start, np.concatenate([[0], self.cum[:-1]]), 0)
+        return np.repeat(self.keys, lens), self.next, self.cum - prev
+
+    def add(self, key: int, nxt: int):
+        succ = self.pending.setdefault(key, {})
+        succ[nxt] = succ.get(nxt, 0) + 1
+        self.pending_n += 1
+
+    def merge(self) -> "SuccessorTable":
+        if not self.pending:
+            return self
+        keys, nxt, counts = self.counts()
+        extra = [(k, n, c) for k, succ in self.pending.items() for n, c in succ.items()]
+        return self.build(
+            np.concatenate([keys, np.array([e[0] for e in extra], dtype=np.int64)]),
+            np.concatenate([nxt, np.array([e[1] for e in extra], dtype=np.int32)]),
+            np.concatenate([counts, np.array([e[2] for e in extra], dtype=np.int64)]),
+        )
+
+    def _find(self, key: int) -> int:
+        i = int(self.keys.searchsorted(key))
+        return i if i < self.keys.size and self.keys[i] == key else -1
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.pending or self._find(key) >= 0
+
+    def sample(self, key: int) -> Optional[int]:
+        """A successor of ``key`` drawn in proportion to its count, i.e.
+        ``random.choice`` over every continuation ever observed."""
+        i = self._find(key)
+        lo = hi = total = 0
+        if i >= 0:
+            lo, hi = int(self.ptr[i]), int(self.ptr[i + 1])
+            total = int(self.cum[hi - 1])
+        succ = self.pending.get(key)
+        extra = sum(succ.values()) if succ else 0
+        if total + extra == 0:
+            return None
+        r = random.randrange(total + extra)
+        if r < total:
+            return int(self.next[lo + int(self.cum[lo:hi].searchsorted(r, side="right"))])
+        r -= total
+        for nxt, c in succ.items():
+            if r < c:
+                return nxt
+            r -= c
+        return None  # unreachable
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.ptr.nbytes + self.next.nbytes + self.cum.nbytes
 
 class MarkovBrain:
+    """Word trigram/bigram chain over interned token ids.
+
+    Trigram contexts are packed as ``(a << 32) | b``, bigram contexts are the
+    token id itself. Sampling is count-weighted, the same distribution as
+    drawing from the raw list of continuations.
+    """
+
     def __init__(self):
-        self.trigrams: Dict[Tuple[str, str], List[str]] = defaultdict(list)
-        self.bigrams: Dict[str, List[str]] = defaultdict(list)
-        self.starters: List[Tuple[str, ...]] = []
-
-    def train(self, messages: List[str]):
-        self.trigrams.clear()
-        self.bigrams.clear()
-        self.starters.clear()
+        self.words: List[str] = []
+        self.vocab: Dict[str, int] = {}
+        self.trigrams = SuccessorTable()
+        self.bigrams = SuccessorTable()
+        # first/second token id of every message (-1: one-word message)
+        self.starters = array("i")
+        self.starters2 = array("i")
+
+    @staticmethod
+    def _pair(a: int, b: int) -> int:
+        return (a << 32) | b if a >= 0 and b >= 0 else -1
+
+    def _ids(self, words: List[str], grow: bool = False) -> List[int]:
+        if not grow:
+            return [self.vocab.get(w, -1) for w in words]
+        out = []
+        for w in words:
+            i = self.vocab.get(w)
+            if i is None:
+                i = self.vocab[w] = len(self.words)
+                self.words.append(w)
+            out.append(i)
+        return out
+
+    def train(self, messages: Iterable[str]):
+        self.words, self.vocab = [], {}
+        self.starters, self.starters2 = array("i"), array("i")
+        tri_keys, tri_next = array("q"), array("i")
+        bi_keys, bi_next = array("q"), array("i")
         for msg in messages:
-            words = tokenize(msg)
-            if not words:
+            ids = self._ids(tokenize(msg), grow=True)
+            if not ids:
                 continue
-            if len(words) >= 2:
-                self.starters.append((words[0], words[1]))
-            else:
-                self.starters.append((words[0],))
-            for i in range(len(words)):
-                if i + 2 < len(words):
-                    self.trigrams[(words[i], words[i + 1])].append(words[i + 2])
-                if i + 1 < len(words):
-                    self.bigrams[words[i]].append(words[i + 1])
+            self.starters.append(ids[0])
+            self.starters2.append(ids[1] if len(ids) >= 2 else -1)
+            for i in range(len(ids) - 1):
+                bi_keys.append(ids[i])
+                bi_next.append(ids[i + 1])
+                if i + 2 < len(ids):
+                    tri_keys.append(self._pair(ids[i], ids[i + 1]))
+                    tri_next.append(ids[i + 2])
+        self.trigrams = SuccessorTable.build(np.frombuffer(tri_keys, dtype=np.int64), np.frombuffer(tri_next, dtype=np.int32))
+        self.bigrams = SuccessorTable.build(np.frombuffer(bi_keys, dtype=np.int64), np.frombuffer(bi_next, dtype=np.int32))
+
+    def update(self, messages: List[str]):
+        """Add messages to the existing tables (used by live ingestion)."""
+        for msg in messages:
+            ids = self._ids(tokenize(msg), grow=True)
+            if not ids:
+                continue
+            self.starters.append(ids[0])
+            self.starters2.append(ids[1] if len(ids) >= 2 else -1)
+            for i in range(len(ids) - 1):
+                self.bigrams.add(ids[i], ids[i + 1])
+                if i + 2 < len(ids):
+                    self.trigrams.add(self._pair(ids[i], ids[i + 1]), ids[i + 2])
+        if self.trigrams.pending_n >= MARKOV_MERGE_EVERY:
+            self.trigrams = self.trigrams.merge()
+        if self.bigrams.pending_n >= MARKOV_MERGE_EVERY:
+            self.bigrams = self.bigrams.merge()
+
+    def _next(self, ids: List[int]) -> Optional[int]:
+        # sample() is None exactly when the context was never seen
+        nxt = None
+        if len(ids) >= 2:
+            nxt = self.trigrams.sample(self._pair(ids[-2], ids[-1]))
+        if nxt is None and ids[-1] >= 0:
+            nxt = self.bigrams.sample(ids[-1])
+        return nxt
 
     def generate(self, seed: str = "", max_words: int = 20) -> str:
-        words = tokenize(seed)
-        result: List[str] = []
-        if len(words) >= 2 and (words[-2], words[-1]) in self.trigrams:
-            result = [words[-2], words[-1]]
-        elif len(words) >= 1 and words[-1] in self.bigrams:
-            result = [words[-1]]
+        ids = self._ids(tokenize(seed))
+        result: List[int] = []
+        if len(ids) >= 2 and self._pair(ids[-2], ids[-1]) in self.trigrams:
+            result = [ids[-2], ids[-1]]
+        elif len(ids) >= 1 and ids[-1] >= 0 and ids[-1] in self.bigrams:
+            result = [ids[-1]]
         elif self.starters:
-            result = list(random.choice(self.starters))
+            k = random.randrange(len(self.starters))
+            result = [self.starters[k]] if self.starters2[k] < 0 else [self.starters[k], self.starters2[k]]
         else:
             return ""
         while len(result) < max_words:
-            if len(result) >= 2 and (result[-2], result[-1]) in self.trigrams:
-                nxt = random.choice(self.trigrams[(result[-2], result[-1])])
-            elif result[-1] in self.bigrams:
-                nxt = random.choice(self.bigrams[result[-1]])
-            else:
+            nxt = self._next(result)
+            if nxt is None:
                 break
             if len(result) >= 3 and nxt == result[-1] == result[-2]:
                 break
             result.append(nxt)
             if len(result) >= 5 and random.random() < 0.22:
                 break
-        return " ".join(result).strip()
+        return " ".join(self.words[i] for i in result).strip()
 
     def continue_from(self, prefix: str, extra_words: int = 8) -> str:
         base = tokenize(prefix)
         if not base:
             return ""
-        result = base[:]
-        while len(result) < len(base) + extra_words:
-            if len(result) >= 2 and (result[-2], result[-1]) in self.trigrams:
-                nxt = random.choice(self.trigrams[(result[-2], result[-1])])
-            elif result[-1] in self.bigrams:
-                nxt = random.choice(self.bigrams[result[-1]])
-            else:
+        words = base[:]
+        ids = self._ids(base)
+        while len(ids) < len(base) + extra_words:
+            nxt = self._next(ids)
+            if nxt is None:
                 break
-            if nxt in result[-4:]:
+            if nxt in ids[-4:]:
                 break
-            result.append(nxt)
-            if len(result) >= len(base) + 3 and random.random() < 0.35:
+            ids.append(nxt)
+            words.append(self.words[nxt])
+            if len(ids) >= len(base) + 3 and random.random() < 0.35:
                 break
-        return " ".join(result).strip()
+        return " ".join(words).strip()
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.trigrams.nbytes + self.bigrams.nbytes
+            + self.starters.itemsize * (len(self.starters) + len(self.starters2))
+        )
+
+    def save(self, prefix: str):
+        for name, table in (("trigrams", self.trigrams.merge()), ("bigrams", self.bigrams.merge())):
+            for part in ("keys", "ptr", "next", "cum"):
+                np.save(f"{prefix}.{name}.{part}.npy", getattr(table, part))
+        np.save(f"{prefix}.starters.npy", np.frombuffer(self.starters, dtype=np.int32))
+        np.save(f"{prefix}.starters2.npy", np.frombuffer(self.starters2, dtype=np.int32))
+        StringArena.from_strings(self.words).save(f"{prefix}.words")
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode: Optional[str] = "r") -> "MarkovBrain":
+        """Tables mapped from ``save`` output (live updates collect in the
+        pending dicts as usual; a merge builds fresh arrays)."""
+        markov = cls()
+        for name in ("trigrams", "bigrams"):
+            table = SuccessorTable()
+            for part in ("keys", "ptr", "next", "cum"):
+                setattr(table, part, np.load(f"{prefix}.{name}.{part}.npy", mmap_mode=mmap_mode))
+            setattr(markov, name, table)
+        # appended to by live updates, so these two are copied
+        markov.starters = array("i", np.load(f"{prefix}.starters.npy").tobytes())
+        markov.starters2 = array("i", np.load(f"{prefix}.starters2.npy").tobytes())
+        markov.words = list(StringArena.load(f"{prefix}.words", mmap_mode=mmap_mode))
+        markov.vocab = {w: i for i, w in enumerate(markov.words)}
+        return markov
+
+class LsaIndex:
+    """Inverted-file (IVF) index over unit-length LSA vectors.
+
+    Spherical k-means splits the rows into ~sqrt(n) cells; a query only
+    visits the rows of the cells whose centroids are closest to it.
+    """
+
+    def __init__(self, centroids: np.ndarray, cell_rows: np.ndarray, cell_offsets: np.ndarray):
+        self.centroids = centroids        # (cells, dims), unit length
+        self.cell_rows = cell_rows        # row ids grouped by cell
+        self.cell_offsets = cell_offsets  # cell c = cell_rows[offsets[c]:offsets[c + 1]]
+
+    @property
+    def cells(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+        out = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], chunk):
+            block = np.asarray(vectors[start:start + chunk])
+            out[start:start + chunk] = np.argmax(block.dot(centroids.T), axis=1)
+        return out
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, iters: int = 8, seed: int = 42) -> "LsaIndex":
+        n = vectors.shape[0]
+        cells = max(1, int(round(math.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        # fit the centroids on a sample; every row is assigned afterwards
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, cells * 32), replace=False))])
+        centroids = sample[rng.choice(sample.shape[0], cells, replace=False)].copy()
+        for _ in range(iters):
+            assign = cls._nearest(sample, centroids)
+            member = sparse.csr_matrix(
+                (np.ones(assign.size), (assign, np.arange(assign.size))), shape=(cells, assign.size),
+            )
+            sums = np.asarray(member.dot(sample))
+            filled = np.linalg.norm(sums, axis=1) > 0
+            # empty cells keep their previous centroid
+            centroids[filled] = l2_normalize(sums[filled])
+        return cls.from_assignment(centroids, cls._nearest(vectors, centroids))
+
+    @classmethod
+    def from_assignment(cls, centroids: np.ndarray, assign: np.ndarray) -> "LsaIndex":
+        cell_rows = np.argsort(assign, kind="stable")
+        cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=centroids.shape[0]))])
+        return cls(centroids, cell_rows, cell_offsets)
+
+    def _assignment(self) -> np.ndarray:
+        assign = np.empty(self.cell_rows.size, dtype=np.int64)
+        for c in range(self.cells):
+            assign[self.cell_rows[self.cell_offsets[c]:self.cell_offsets[c + 1]]] = c
+        return assign
+
+    def extend(self, vectors: np.ndarray) -> "LsaIndex":
+        """Index with ``vectors`` appended as the next row ids (assigned to
+        the existing cells; the centroids are not refitted)."""
+        return self.from_assignment(self.centroids, np.concatenate([self._assignment(), self._nearest(vectors, self.centroids)]))
+
+    def rows(self, lo: int, hi: int) -> "LsaIndex":
+        """The same cells holding only rows [lo, hi), renumbered from 0."""
+        return self.from_assignment(self.centroids, self._assignment()[lo:hi])
+
+    def candidates(self, query: np.ndarray, probes: int) -> np.ndarray:
+        """Row ids (ascending) in the ``probes`` cells nearest ``query``."""
+        probes = min(probes, self.cells)
+        scores = self.centroids.dot(query)
+        probe = np.argpartition(-scores, probes - 1)[:probes]
+        offsets = self.cell_offsets
+        return np.sort(np.concatenate([self.cell_rows[offsets[c]:offsets[c + 1]] for c in probe]))
+
+class ReplyGraph:
+    """Sparse, symmetric kNN graph over the distinct replies (nodes) in the
+    reply vector space; edge weights are cosine similarities.
+
+    Exact duplicates share a node, so a cluster of identical answers is one
+    node and never crowds real neighbours out of the k slots.
+    """
+
+    def __init__(self, edges: sparse.csr_matrix):
+        self.edges = edges  # (nodes, nodes), no self loops
+
+    @property
+    def nodes(self) -> int:
+        return self.edges.shape[0]
+
+    @staticmethod
+    def _knn(vectors, start: int, k: int, min_sim: float, block_bytes: int = REPLY_GRAPH_BLOCK_BYTES,
+             executor: Optional[Executor] = None):
+        """COO triplets of the ``k`` nearest nodes of rows ``start:`` among
+        all rows of ``vectors`` (unit length, CSR). Works on the sparse
+        product only, in row blocks of about ``block_bytes``; blocks are
+        independent and the product releases the GIL, so an ``executor``
+        (threads) spreads them over cores."""
+        vectors = sparse.csr_matrix(vectors, dtype=np.float32)
+        others = vectors.T.tocsr()  # the product wants CSR on both sides
+        n = vectors.shape[0]
+        # upper bound of each row's product nnz (the rows sharing a column
+        # with it), costed as float32 value + int32 column + sort keys/order
+        df = np.bincount(vectors.indices, minlength=vectors.shape[1]).astype(np.float64)
+        hits = sparse.csr_matrix((np.ones(vectors.nnz), vectors.indices, vectors.indptr), shape=vectors.shape)
+        ends = np.cumsum(np.minimum(hits[start:].dot(df), n))
+        budget = max(1, block_bytes // 32)
+        bounds = [start]
+        while bounds[-1] < n:
+            done = ends[bounds[-1] - start - 1] if bounds[-1] > start else 0.0
+            cut = start + int(np.searchsorted(ends, done + budget, side="right"))
+            bounds.append(min(n, max(bounds[-1] + 1, cut)))
+
+        def block_knn(lo: int, hi: int):
+            sims = vectors[lo:hi].dot(others).tocoo()
+            keep = (sims.data >= min_sim) & (sims.data > 0) & (sims.row + lo != sims.col)
+            rows, cols, vals = sims.row[keep], sims.col[keep], sims.data[keep]
+            # per row, strongest first (sims are in (0, 1]); the first k of
+            # each row survive
+            order = np.argsort(rows + (1.0 - vals.astype(np.float64)), kind="stable")
+            rows, cols, vals = rows[order], cols[order], vals[order]
+            first = np.searchsorted(rows, np.arange(hi - lo))
+            top = np.arange(rows.size) - first[rows] < k
+            return rows[top].astype(np.int64) + lo, cols[top].astype(np.int64), vals[top]
+
+        spans = list(zip(bounds[:-1], bounds[1:]))
+        blocks = list(executor.map(block_knn, *zip(*spans)) if executor and spans else
+                      (block_knn(lo, hi) for lo, hi in spans))
+        if not blocks:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, cols, vals = zip(*blocks)
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+
+    @classmethod
+    def build(cls, vectors, k: int = REPLY_GRAPH_K, min_sim: float = REPLY_GRAPH_MIN_SIM,
+              executor: Optional[Executor] = None) -> "ReplyGraph":
+        n = vectors.shape[0]
+        rows, cols, vals = cls._knn(vectors, 0, k, min_sim, executor=executor)
+        edges = sparse.csr_matrix((vals, (rows, cols)), shape=(n, n), dtype=np.float32)
+        return cls(edges.maximum(edges.T).tocsr())
+
+    def extend(self, vectors, k: int = REPLY_GRAPH_K, min_sim: float = REPLY_GRAPH_MIN_SIM) -> "ReplyGraph":
+        """Graph with the rows of ``vectors`` past ``nodes`` added as new
+        nodes, linked to their neighbours among all nodes. Existing edges are
+        kept; old nodes gain the new ones as extra neighbours."""
+        n = vectors.shape[0]
+        rows, cols, vals = self._knn(vectors, self.nodes, k, min_sim)
+        old = self.edges.tocoo()
+        edges = sparse.csr_matrix(
+            (np.concatenate([old.data, vals]), (np.concatenate([old.row, rows]), np.concatenate([old.col, cols]))),
+            shape=(n, n), dtype=np.float32,
+        )
+        return ReplyGraph(edges.maximum(edges.T).tocsr())
+
+    def block(self, nodes: np.ndarray) -> np.ndarray:
+        """Dense similarity sub-matrix of ``nodes`` (diagonal left 0)."""
+        e = self.edges
+        starts, ends = e.indptr[nodes], e.indptr[nodes + 1]
+        lens = ends - starts
+        pos = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens) + np.arange(lens.sum())
+        rows = np.repeat(np.arange(nodes.size), lens)
+        where = np.full(self.nodes, -1, dtype=np.int64)
+        where[nodes] = np.arange(nodes.size)
+        cols = where[e.indices[pos]]
+        hit = cols >= 0
+        out = np.zeros((nodes.size, nodes.size))
+        out[rows[hit], cols[hit]] = e.data[pos[hit]]
+        return out
+
+class PairFeatures:
+    """Static per-pair properties candidate scoring needs, aligned with
+    CorpusRetriever row ids and computed once at fit/ingest time instead of
+    re-tokenizing every candidate on every request.
+
+    Canonical token sets are stored CSR-style as sorted int32 ids into a
+    shared token vocabulary: row i = ids[ptr[i]:ptr[i + 1]].
+    """
+
+    COLUMNS = (
+        "reply_len", "parent_question", "reply_generic",
+        "parent_ptr", "parent_ids", "reply_ptr", "reply_ids",
+    )
+
+    def __init__(self, reply_len, parent_question, reply_generic, parent_ptr, parent_ids, reply_ptr, reply_ids):
+        self.reply_len = reply_len              # int32, len(tokenize(reply))
+        self.parent_question = parent_question  # bool, is_question(parent)
+        self.reply_generic = reply_generic      # bool, looks_generic(reply)
+        self.parent_ptr, self.parent_ids = parent_ptr, parent_ids
+        self.reply_ptr, self.reply_ids = reply_ptr, reply_ids
+
+    def __len__(self) -> int:
+        return self.reply_len.shape[0]
+
+    @staticmethod
+    def _token_csr(texts: List[str], vocab: Dict[str, int]) -> Tuple[np.ndarray, np.ndarray]:
+        ptr = np.zeros(len(texts) + 1, dtype=np.int64)
+        ids: List[int] = []
+        for i, text in enumerate(texts):
+            ids.extend(sorted(vocab.setdefault(tok, len(vocab)) for tok in set(canon(text).split())))
+            ptr[i + 1] = len(ids)
+        return ptr, np.array(ids, dtype=np.int32)
+
+    @classmethod
+    def build(cls, keys: List[str], replies: List[str], vocab: Dict[str, int]) -> "PairFeatures":
+        """Features of (canonical key, raw reply) rows; new tokens are added
+        to ``vocab`` in place."""
+        n = len(keys)
+        return cls(
+            np.fromiter((len(tokenize(r)) for r in replies), dtype=np.int32, count=n),
+            np.fromiter((is_question(k) for k in keys), dtype=bool, count=n),
+            np.fromiter((looks_generic(r) for r in replies), dtype=bool, count=n),
+            *cls._token_csr(keys, vocab),
+            *cls._token_csr(replies, vocab),
+        )
+
+    @classmethod
+    def concat(cls, a: "PairFeatures", b: "PairFeatures") -> "PairFeatures":
+        return cls(
+            np.concatenate([a.reply_len, b.reply_len]),
+            np.concatenate([a.parent_question, b.parent_question]),
+            np.concatenate([a.reply_generic, b.reply_generic]),
+            np.concatenate([a.parent_ptr, b.parent_ptr[1:] + a.parent_ptr[-1]]),
+            np.concatenate([a.parent_ids, b.parent_ids]),
+            np.concatenate([a.reply_ptr, b.reply_ptr[1:] + a.reply_ptr[-1]]),
+            np.concatenate([a.reply_ids, b.reply_ids]),
+        )
+
+    @staticmethod
+    def _take_csr(ptr: np.ndarray, ids: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        starts = ptr[rows]
+        lens = ptr[rows + 1] - starts
+        new_ptr = np.concatenate([[0], np.cumsum(lens)]).astype(np.int64)
+        pos = np.repeat(starts - new_ptr[:-1], lens) + np.arange(new_ptr[-1])
+        return new_ptr, ids[pos]
+
+    def take(self, rows: np.ndarray) -> "PairFeatures":
+        """Sub-table of ``rows``, in that order."""
+        return PairFeatures(
+            self.reply_len[rows], self.parent_question[rows], self.reply_generic[rows],
+            *self._take_csr(self.parent_ptr, self.parent_ids, rows),
+            *self._take_csr(self.reply_ptr, self.reply_ids, rows),
+        )
+
+    @staticmethod
+    def overlaps(ptr: np.ndarray, ids: np.ndarray, query: dict) -> np.ndarray:
+        """``lexical_overlap`` of the ``query_features`` input against the
+        token-id set of every row (Jaccard; input tokens unknown to the
+        vocabulary still count towards the union)."""
+        lens = ptr[1:] - ptr[:-1]
+        out = np.zeros(lens.size)
+        qids = query["token_array"]
+        if not query["n_tokens"]:
+            return out
+        if qids.size:
+            pos = np.minimum(np.searchsorted(qids, ids), qids.size - 1)
+            seen = np.concatenate([[0], np.cumsum(qids[pos] == ids)])
+            inter = seen[ptr[1:]] - seen[ptr[:-1]]
+        else:
+            inter = np.zeros(lens.size, dtype=np.int64)
+        ok = lens > 0
+        out[ok] = inter[ok] / (query["n_tokens"] + lens[ok] - inter[ok])
+        return out
+
+class StringArena:
+    """Sequence of strings packed as UTF-8 into one byte buffer plus an
+    int64 offsets array (string i = data[offsets[i]:offsets[i + 1]]).
+
+    Strings are decoded on access only, so a memory-mapped arena costs
+    nothing per row until a row is actually read. Appends go to a plain
+    list tail; ``packed()`` folds it in.
+    """
+
+    __slots__ = ("data", "offsets", "_tail")
+
+    def __init__(self, data: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None):
+        self.data = np.zeros(0, dtype=np.uint8) if data is None else data
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self._tail: List[str] = []
+
+    @classmethod
+    def from_strings(cls, strings) -> "StringArena":
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return self.offsets.size - 1 + len(self._tail)
+
+    def __getitem__(self, i: int) -> str:
+        n = self.offsets.size - 1
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i >= n:
+            return self._tail[i - n]
+        if i < 0:
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        data, offsets = self.data, self.offsets.tolist()
+        for lo, hi in zip(offsets, offsets[1:]):
+            yield data[lo:hi].tobytes().decode("utf-8")
+        yield from list(self._tail)
+
+    def append(self, s: str):
+        self._tail.append(s)
+
+    def extend(self, strings):
+        self._tail.extend(strings)
+
+    def packed(self) -> "StringArena":
+        if not self._tail:
+            return self
+        tail = StringArena.from_strings(self._tail)
+        return StringArena(
+            np.concatenate([self.data, tail.data]),
+            np.concatenate([self.offsets, tail.offsets[1:] + self.offsets[-1]]),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes + sum(sys.getsizeof(s) for s in self._tail)
+
+    def save(self, prefix: str):
+        arena = self.packed()
+        np.save(f"{prefix}.data.npy", arena.data)
+        np.save(f"{prefix}.offsets.npy", arena.offsets)
+
+    @classmethod
+    def load(cls, prefix: str, mmap_mode: Optional[str] = "r") -> "StringArena":
+        return cls(np.load(f"{prefix}.data.npy", mmap_mode=mmap_mode), np.load(f"{prefix}.offsets.npy", mmap_mode=mmap_mode))
+
+class CandidateSet:
+    """Retrieved candidates as aligned arrays, best similarity first.
+
+    ``group`` numbers the distinct replies among the candidates and
+    ``norms[g]`` is the reply_norm of group g, so dedup and the anti-repeat
+    filter work on small integer masks. The log terms of the scoring
+    formula that depend only on the retrieval result are precomputed.
+    """
+
+    __slots__ = ("idx", "sim", "freq", "group", "norms", "features", "log_freq", "log_consensus")
+
+    def __init__(self, idx: np.ndarray, sim: np.ndarray, freq: np.ndarray, group: np.ndarray,
+                 norms: List[str], features: "PairFeatures", consensus: np.ndarray):
+        self.idx = idx
+        self.sim = sim
+        self.freq = freq
+        self.group = group
+        self.norms = norms
+        self.features = features
+        # math.log1p, not np.log1p: SIMD builds of numpy may differ in the
+        # last ulp, and scores must match the scalar formula exactly
+        self.log_freq = np.fromiter(map(math.log1p, freq.tolist()), dtype=float, count=freq.size)
+        self.log_consensus = np.fromiter(
+            (math.log1p(max(0.0, c)) for c in consensus.tolist()), dtype=float, count=consensus.size,
+        )
+        for arr in (idx, sim, freq, group, self.log_freq, self.log_consensus):
+            arr.flags.writeable = False
+
+    def __len__(self) -> int:
+        return self.idx.size
+
+class RetrievalCache:
+    """Bounded LRU (with optional TTL) of retrieval results.
+
+    ``clear`` bumps ``generation``; a result computed against an older
+    generation is never stored, so an invalidation can't be undone by a
+    lookup that was already in flight.
+    """
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, generation: int):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+class LatencyStats:
+    """Rolling per-stage latency histograms plus event counters.
+
+    ``lap(stage, since)`` records ``perf_counter() - since`` and returns the
+    new ``perf_counter()``, so consecutive stages chain on one clock read
+    each. A record is a bucket index computation and an increment.
+    """
+
+    # bucket i covers [2**e * (0.5 + s / (2 * SUB)), ...) microseconds, with
+    # e, s = divmod(i, SUB); 2**40 us is far past any reply
+    BUCKETS = 40 * STATS_SUB_BUCKETS
+
+    def __init__(self, window: float = STATS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._current: Dict[str, List[int]] = {}
+            self._previous: Dict[str, List[int]] = {}
+            self._rolled = time.perf_counter()
+            self.counters: Counter = Counter()
+            self.started = time.time()
+
+    @staticmethod
+    def _bucket(us: float) -> int:
+        if us < 1.0:
+            return 0
+        m, e = math.frexp(us)  # us = m * 2**e, 0.5 <= m < 1
+        return min(e * STATS_SUB_BUCKETS + int((m - 0.5) * 2 * STATS_SUB_BUCKETS), LatencyStats.BUCKETS - 1)
+
+    @staticmethod
+    def _bucket_ms(i: np.ndarray) -> np.ndarray:
+        e, s = np.divmod(i, STATS_SUB_BUCKETS)
+        # bucket midpoint
+        return np.ldexp(0.5 + (s + 0.5) / (2 * STATS_SUB_BUCKETS), e) / 1000.0
+
+    def _roll(self, now: float):
+        # caller holds the lock
+        if now - self._rolled > self.window:
+            # after a whole idle window the current one is stale too
+            self._previous = self._current if now - self._rolled <= 2 * self.window else {}
+            self._current = {}
+            self._rolled = now
+
+    def lap(self, stage: str, since: float) -> float:
+        now = time.perf_counter()
+        i = self._bucket((now - since) * 1e6)
+        with self._lock:
+            self._roll(now)
+            hist = self._current.get(stage)
+            if hist is None:
+                hist = self._current[stage] = [0] * self.BUCKETS
+            hist[i] += 1
+        return now
+
+    def count(self, event: str, n: int = 1):
+        with self._lock:
+            self.counters[event] += n
+
+    def summary(self) -> dict:
+        """{"stages": {stage: count, p50/p95/p99 in ms}, "counters": {...}}."""
+        with self._lock:
+            self._roll(time.perf_counter())
+            hists = {
+                stage: np.add(self._current.get(stage, 0), self._previous.get(stage, 0))
+                for stage in set(self._current) | set(self._previous)
+            }
+            counters = dict(self.counters)
+        stages = {}
+        for stage, hist in sorted(hists.items()):
+            total = int(hist.sum())
+            # first bucket whose cumulative count reaches q of the total
+            ranks = np.ceil(np.array([0.50, 0.95, 0.99]) * total)
+            p50, p95, p99 = self._bucket_ms(np.searchsorted(np.cumsum(hist), ranks)).round(3).tolist()
+            stages[stage] = {"count": total, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        return {"uptime_s": round(time.time() - self.started, 1), "stages": stages, "counters": counters}
+
+# process-wide; every retriever and brain in the process records here
+STATS = LatencyStats()
+
+class StackSampler:
+    """Statistical profiler over live traffic.
+
+    A background thread reads every other thread's Python stack through
+    ``sys._current_frames`` each ``interval`` seconds and counts the stacks
+    that pass through one of the ``focus`` code objects (the request
+    handlers), so idle readers and pollers don't drown the signal. The
+    sampled threads never stop; a sample costs the sampler one GIL turn.
+    """
+
+    def __init__(self, focus: Iterable, interval: float = PROFILE_INTERVAL):
+        self.focus = frozenset(focus)
+        self.interval = interval
+
+    def sample(self, seconds: float) -> Tuple[Counter, int]:
+        """(Counter of root-first code-object stacks, number of ticks)."""
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        ticks = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                busy = False
+                while frame is not None:
+                    busy = busy or frame.f_code in self.focus
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if busy:
+                    stacks[tuple(reversed(stack))] += 1
+            ticks += 1
+            time.sleep(self.interval)
+        return stacks, ticks
+
+    @staticmethod
+    def label(code) -> str:
+        name = getattr(code, "co_qualname", code.co_name)
+        return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    @classmethod
+    def collapsed(cls, stacks: Counter) -> List[str]:
+        return [f"{';'.join(cls.label(c) for c in stack)} {n}" for stack, n in stacks.most_common()]
+
+    @classmethod
+    def hottest(cls, stacks: Counter, top: int = PROFILE_TOP) -> List[dict]:
+        """The ``top`` functions by self samples (innermost frame), with their
+        total samples (anywhere on the stack), as % of the sampled stacks."""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, n in stacks.items():
+            own[stack[-1]] += n
+            for code in set(stack):
+                total[code] += n
+        samples = sum(stacks.values()) or 1
+        return [
+            {"function": cls.label(code), "self_pct": round(100.0 * n / samples, 1), "total_pct": round(100.0 * total[code] / samples, 1)}
+            for code, n in own.most_common(top)
+        ]
+
+class RecentWindow:
+    """The last ``maxlen`` normalized replies, as hash(norm) in a ring.
+
+    ``shared`` puts the ring in shared memory so pre-forked serve workers
+    (which inherit one hash seed) all avoid each other's recent answers.
+    """
+
+    def __init__(self, maxlen: int = 15, buffer=None, lock=None):
+        self.maxlen = maxlen
+        # slots [:maxlen] hold the hashes, slot [maxlen] counts appends
+        self._ring = np.frombuffer(buffer, dtype=np.int64) if buffer is not None else np.zeros(maxlen + 1, dtype=np.int64)
+        self._lock = lock if lock is not None else threading.Lock()
+
+    @classmethod
+    def shared(cls, maxlen: int, ctx) -> "RecentWindow":
+        return cls(maxlen, ctx.RawArray("q", maxlen + 1), ctx.Lock())
+
+    def hashes(self) -> np.ndarray:
+        """Hashes in the window, oldest first."""
+        with self._lock:
+            n = int(self._ring[self.maxlen])
+            if n <= self.maxlen:
+                return self._ring[:n].copy()
+            start = n % self.maxlen
+            return np.concatenate([self._ring[start:self.maxlen], self._ring[:start]])
+
+    def last(self) -> Optional[int]:
+        with self._lock:
+            n = int(self._ring[self.maxlen])
+            return int(self._ring[(n - 1) % self.maxlen]) if n else None
+
+    def append(self, norm: str):
+        with self._lock:
+            n = int(self._ring[self.maxlen])
+            self._ring[n % self.maxlen] = hash(norm)
+            self._ring[self.maxlen] = n + 1
+
+    def reset(self, hashes=()):
+        hashes = np.asarray(hashes, dtype=np.int64)[-self.maxlen:]
+        with self._lock:
+            self._ring[:hashes.size] = hashes
+            self._ring[self.maxlen] = hashes.size
+
+    def __contains__(self, norm: str) -> bool:
+        return bool((self.hashes() == hash(norm)).any())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return min(int(self._ring[self.maxlen]), self.maxlen)
+
+def _posting_cosines(vecs, postings: sparse.csc_matrix, row_norms: np.ndarray) -> sparse.csr_matrix:
+    """TF-IDF cosines of (m x F) query rows against the rows of a posting
+    view. Multiplying by its transpose only touches the posting lists of
+    the queries' non-zero terms."""
+    vecs = sparse.csr_matrix(vecs)
+    q_norms = np.sqrt(np.asarray(vecs.multiply(vecs).sum(axis=1)).ravel())
+    q_norms[q_norms == 0] = 1.0  # empty rows have no postings anyway
+    sims = sparse.csr_matrix(vecs.dot(postings.T))
+    sims.data /= np.repeat(q_norms, np.diff(sims.indptr)) * row_norms[sims.indices]
+    return sims
+
+def _lsa_cosines(lsa_vecs: np.ndarray, lsa_matrix: np.ndarray, index: Optional[LsaIndex], probes: int) -> sparse.csr_matrix:
+    """LSA cosines of unit-length query rows against ``lsa_matrix``,
+    restricted per query to the rows its ``probes`` nearest IVF cells hold
+    (every row when there is no index or ``probes`` is 0)."""
+    # rows of lsa_matrix are unit length, so a dot product is the cosine
+    if index is None or probes <= 0:
+        return sparse.csr_matrix(lsa_vecs.dot(lsa_matrix.T))
+    # rows outside the probed cells keep their lexical score only
+    per_query = [index.candidates(v, probes) for v in lsa_vecs]
+    rows = np.unique(np.concatenate(per_query))
+    dense = np.asarray(lsa_matrix[rows]).dot(lsa_vecs.T)  # (|rows| x m)
+    cols = np.concatenate(per_query)
+    vals = np.concatenate([dense[np.searchsorted(rows, ids), j] for j, ids in enumerate(per_query)])
+    owner = np.repeat(np.arange(len(per_query)), [ids.size for ids in per_query])
+    return sparse.csr_matrix((vals, (owner, cols)), shape=(len(per_query), lsa_matrix.shape[0]))
+
+def _with_semantic(sims: sparse.csr_matrix, weak: np.ndarray, semantic: sparse.csr_matrix) -> sparse.csr_matrix:
+    """``sims`` with the LSA boost of the ``weak`` query rows added."""
+    # scatter the weak queries' rows back into place
+    place = sparse.csr_matrix((np.ones(weak.size), (weak, np.arange(weak.size))), shape=(sims.shape[0], weak.size))
+    return sparse.csr_matrix(sims + place.dot(semantic) * LSA_WEIGHT)
+
+def _mixed_tops(sims: sparse.csr_matrix, mix: sparse.csr_matrix, offset: int, limit: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """For each row of ``mix`` (blend weights over the query rows of
+    ``sims``), the ``limit`` best (row id + ``offset``, blended sim)."""
+    mixed = sparse.csr_matrix(mix.dot(sims))
+    out = []
+    for r in range(mixed.shape[0]):
+        lo, hi = mixed.indptr[r], mixed.indptr[r + 1]
+        out.append(CorpusRetriever._top(mixed.indices[lo:hi].astype(np.int64) + offset, mixed.data[lo:hi], limit))
+    return out
+
+def _shard_main(conn):
+    """Body of a retrieval shard process: build the posting view of its
+    rows, then answer scatter calls until the pipe closes."""
+    lo, matrix, lsa_matrix, index = conn.recv()
+    postings, row_norms = CorpusRetriever._posting_view(matrix)
+    del matrix
+    conn.send(postings.shape[0])
+    lexical = None
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        if msg is None:
+            return
+        try:
+            if msg[0] == "lexical":
+                # kept for the "semantic" call of the same query, if any
+                _, vecs, mix, limit = msg
+                lexical = _posting_cosines(vecs, postings, row_norms)
+                answer = (lexical.max(axis=1).toarray().ravel(), _mixed_tops(lexical, mix, lo, limit))
+            else:
+                _, weak, lsa_vecs, probes, mix, limit = msg
+                sims = _with_semantic(lexical, weak, _lsa_cosines(lsa_vecs, lsa_matrix, index, probes))
+                answer = _mixed_tops(sims, mix, lo, limit)
+        except Exception as e:
+            answer = RuntimeError(f"shard at row {lo}: {e}")
+        try:
+            conn.send(answer)
+        except OSError:
+            return  # the retriever dropped the shards mid-query
+
+class RetrievalShards:
+    """The main segment of a fitted retriever split by row range, each range
+    searched by its own process.
+
+    The shards get their rows already projected into the retriever's
+    feature space (one vectorizer and SVD for all) and their slice of its
+    IVF cells, so their cosines are directly comparable and they probe the
+    same cells: a query is vectorized once, fanned out, and the per-shard
+    top-k lists merge into the global top-k an in-process search would
+    return. Each shard builds its own posting view. One query at a time holds
+    the pipes (``lock``) for its lexical call and, if any of its variants
+    is weak, the semantic call that follows. A shard that dies is started
+    again from the same rows (``revive``).
+    """
+
+    def __init__(self, source: tuple, bounds: List[int]):
+        # (matrix, lsa_matrix, lsa_index) the row ranges are cut from
+        self.source = source
+        self.bounds = bounds
+        self.procs: list = [None] * (len(bounds) - 1)
+        self.conns: list = [None] * (len(bounds) - 1)
+        # shards the last ``scatter`` reached, i.e. owing an answer, and
+        # the ones whose pipe broke since
+        self.sent: List[bool] = [False] * (len(bounds) - 1)
+        self.broken: set = set()
+        self.lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.conns)
+
+    @classmethod
+    def start(cls, matrix, lsa_matrix: Optional[np.ndarray], lsa_index: Optional[LsaIndex], count: int) -> "RetrievalShards":
+        bounds = np.linspace(0, matrix.shape[0], count + 1).astype(np.int64).tolist()
+        shards = cls((matrix, lsa_matrix, lsa_index), bounds)
+        try:
+            for i in range(count):
+                shards._spawn(i)
+            shards.gather()  # every shard has built its index
+        except Exception:
+            shards.close()
+            raise
+        return shards
+
+    def _spawn(self, i: int):
+        # spawn, not fork: shards are also started from the ingest thread
+        ctx = multiprocessing.get_context("spawn")
+        matrix, lsa_matrix, lsa_index = self.source
+        lo, hi = self.bounds[i], self.bounds[i + 1]
+        conn, child = ctx.Pipe()
+        proc = ctx.Process(target=_shard_main, args=(child,), name=f"brain-shard-{i}", daemon=True)
+        proc.start()
+        child.close()
+        conn.send((
+            lo, sparse.csr_matrix(matrix[lo:hi]),
+            None if lsa_matrix is None else np.array(lsa_matrix[lo:hi]),
+            None if lsa_index is None else lsa_index.rows(lo, hi),
+        ))
+        self.procs[i], self.conns[i] = proc, conn
+        self.sent[i] = True
+
+    def revive(self) -> int:
+        """Start dead shards again from their rows (call with ``lock``
+        held); returns how many were restarted."""
+        dead = sorted(self.broken | {i for i, proc in enumerate(self.procs) if proc is not None and not proc.is_alive()})
+        self.broken = set()
+        for i in dead:
+            self.conns[i].close()
+            if self.procs[i].is_alive():
+                self.procs[i].kill()
+            self.procs[i].join()
+            self._spawn(i)
+        if dead:
+            self.sent = [i in dead for i in range(self.count)]
+            self.gather()
+        return len(dead)
+
+    def scatter(self, msg: tuple):
+        if not self.conns:
+            raise OSError("shards are closed")
+        for i, conn in enumerate(self.conns):
+            try:
+                conn.send(msg)
+                self.sent[i] = True
+            except (OSError, ValueError):
+                self.sent[i] = False
+                self.broken.add(i)
+        if not all(self.sent):
+            self.gather()  # keep the live shards' pipes in step
+            raise OSError(f"shards {sorted(self.broken)} unreachable")
+
+    def gather(self) -> list:
+        out = []
+        for i, (conn, sent) in enumerate(zip(self.conns, self.sent)):
+            try:
+                out.append(conn.recv() if sent else None)
+            except (EOFError, OSError) as e:
+                self.broken.add(i)
+                out.append(e)
+        self.sent = [False] * self.count
+        for res in out:
+            if isinstance(res, Exception):
+                raise res
+        return out
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                if conn is None:
+                    continue
+                try:
+                    conn.send(None)
+                except (OSError, ValueError):
+                    pass
+                conn.close()
+            for proc in self.procs:
+                if proc is None:
+                    continue
+                proc.join(timeout=5)
+                if proc.is_alive():
+                    proc.kill()
+            self.conns, self.procs, self.sent = [], [], []
 
 class CorpusRetriever:
     """TF-IDF (word + char n-grams) with a TruncatedSVD/LSA semantic layer.
 
     Final similarity blends raw lexical TF-IDF cosine with latent-semantic
     cosine, so paraphrases that share no words/letters can still match.
+
+    Rows learned after the fit live in a small delta segment (``delta_*``)
+    projected into the frozen feature space; row ids continue after the main
+    matrix, so ``keys``/``replies`` cover both segments.
+
+    Lexical lookups walk the posting lists of a column-oriented copy of the
+    main matrix (``postings``), so a query only touches the rows sharing at
+    least one n-gram with it instead of the whole corpus.
     """
 
-    def __init__(self):
-        self.keys: List[str] = []
-        self.replies: List[str] = []
-        self.reply_norms: List[str] = []
-        self.reply_freq: Counter = Counter()
+    def __init__(self, feature_mode: Optional[str] = None, hash_buckets: Optional[int] = None):
+        self.feature_mode = feature_mode or FEATURE_MODE
+        self.hash_buckets = hash_buckets or HASH_BUCKETS
+        if self.feature_mode not in ("vocab", "hashed"):
+            raise ValueError(f"unknown feature mode {self.feature_mode!r}")
+        # row strings live in packed UTF-8 arenas, decoded on access
+        self.keys = StringArena()
+        self.replies = StringArena()
+        # interned replies: ``reply_ids[row]`` indexes ``reply_vocab`` (the
+        # distinct reply_norms) and the rows of ``reply_matrix``;
+        # ``reply_freq[id]`` counts the pairs answering with that reply
+        self.reply_vocab = StringArena()
+        self._reply_index: Optional[Dict[str, int]] = {}
+        self.reply_ids = np.zeros(0, dtype=np.int32)
+        self.reply_freq = np.zeros(0, dtype=np.int64)
         self.vectorizer: Optional[FeatureUnion] = None
         self.matrix = None
+        # CSC view of ``matrix`` (column j = posting list of n-gram j) and the
+        # row L2 norms needed to turn posting dot products into cosines
+        self.postings = None
+        self.row_norms = None
         self.svd: Optional[TruncatedSVD] = None
+        # feature columns the SVD was fitted on (None = all); the hashed
+        # space is mostly empty buckets, which would only bloat components_
+        self.lsa_columns: Optional[np.ndarray] = None
+        self._lsa_column_map: Optional[np.ndarray] = None
         self.lsa_matrix = None
-        # second vector space over the REPLIES themselves, for reply-space
-        # consensus (how much the retrieved neighbourhood agrees on an answer)
+        self.lsa_index: Optional[LsaIndex] = None
+        self.lsa_probes = LSA_PROBES
+        # second vector space over the distinct REPLIES themselves, for
+        # reply-space consensus (how much the retrieved neighbourhood agrees
+        # on an answer), with the kNN graph between them
         self.reply_vectorizer: Optional[FeatureUnion] = None
         self.reply_matrix = None
+        self.reply_graph: Optional[ReplyGraph] = None
+        # scoring features per row, token ids index into ``token_vocab``
+        self.token_vocab: Dict[str, int] = {}
+        self.features: Optional[PairFeatures] = None
+        # main-segment searches go through these processes when started
+        self.shards: Optional[RetrievalShards] = None
+        self.cache = RetrievalCache()
+        self._reset_delta()
+
+    def _reset_delta(self):
+        self.delta_matrix = None
+        self.delta_lsa = None
+        self.delta_reply_matrix = None
+        self.delta_features: Optional[PairFeatures] = None
+
+    @staticmethod
+    def _n_features(vectorizer: FeatureUnion) -> int:
+        return sum(
+            len(t.vocabulary_) if hasattr(t, "vocabulary_") else t.named_steps["hash"].n_features
+            for _, t in vectorizer.transformer_list
+        )
 
     @staticmethod
-    def _build_vectorizer() -> FeatureUnion:
+    def _build_vectorizer(feature_mode: Optional[str] = None, hash_buckets: Optional[int] = None) -> FeatureUnion:
+        # everything downstream (SVD, LSA rows, IVF centroids, delta rows)
+        # inherits the dtype of the TF-IDF output
+        dtype = np.float32 if COMPACT_MATRICES else np.float64
+        if (feature_mode or FEATURE_MODE) == "hashed":
+            buckets = hash_buckets or HASH_BUCKETS
+
+            def hashed(analyzer: str, ngram_range: Tuple[int, int]) -> Pipeline:
+                # counts (not signed, not normalized) -> same tf-idf as below
+                return Pipeline([
+                    ("hash", HashingVectorizer(
+                        analyzer=analyzer,
+                        ngram_range=ngram_range,
+                        n_features=buckets,
+                        alternate_sign=False,
+                        norm=None,
+                        dtype=dtype,
+                    )),
+                    ("idf", TfidfTransformer(sublinear_tf=True)),
+                ])
+
+            return FeatureUnion([("word", hashed("word", (1, 2))), ("char", hashed("char_wb", (3, 5)))])
         return FeatureUnion([
             ("word", TfidfVectorizer(
                 analyzer="word",
                 ngram_range=(1, 2),
                 min_df=2,
                 sublinear_tf=True,
+                dtype=dtype,
             )),
             ("char", TfidfVectorizer(
                 analyzer="char_wb",
                 ngram_range=(3, 5),
                 min_df=1,
                 sublinear_tf=True,
+                dtype=dtype,
             )),
         ])
 
     def train(self, keys: List[str], replies: List[str]):
-        cleaned = []
-        for k, r in zip(keys, replies):
+        self.train_pairs(zip(keys, replies))
+
+    def train_pairs(self, pairs: Iterable[Tuple[str, str]]):
+        """Fit on (parent, reply) rows, consumed in a single pass, so a
+        generator over a DB cursor never materializes the raw rows."""
+        keys: List[str] = []
+        replies: List[str] = []
+        norms: List[str] = []
+        for k, r in pairs:
             ck = canon(k)
             nr = normalize(r)
             if ck and nr:
-                cleaned.append((ck, r, nr))
-        if not cleaned:
-            self.keys, self.replies, self.reply_norms = [], [], []
-            self.reply_freq = Counter()
+                keys.append(ck)
+                replies.append(r)
+                norms.append(nr)
+        self.train_clean(keys, replies, norms)
+
+    def train_clean(self, keys: List[str], replies: List[str], norms: List[str],
+                    pool: Optional[Executor] = None):
+        """Fit on canonical keys, raw replies and their normalized forms.
+
+        With a process ``pool`` the four TF-IDF fits run in workers while
+        this process builds the pair features, then SVD and the reply graph
+        run side by side on threads. Stage timings go to stderr.
+        """
+        self.stop_shards()
+        self._reset_delta()
+        if not keys:
+            self.keys, self.replies = StringArena(), StringArena()
+            self._intern_replies([])
             self.vectorizer = None
             self.matrix = None
+            self.postings = None
+            self.row_norms = None
             self.svd = None
+            self._set_lsa_columns(None)
             self.lsa_matrix = None
+            self.lsa_index = None
             self.reply_vectorizer = None
             self.reply_matrix = None
+            self.reply_graph = None
+            self.token_vocab = {}
+            self.features = None
+            self.cache.clear()
             return
-        self.keys = [k for k, _, _ in cleaned]
-        self.replies = [r for _, r, _ in cleaned]
-        self.reply_norms = [nr for _, _, nr in cleaned]
-        self.reply_freq = Counter(self.reply_norms)
-        self.vectorizer = self._build_vectorizer()
-        self.matrix = self.vectorizer.fit_transform(self.keys)
-        self._fit_lsa()
-        # vectorize the replies too so we can measure reply-to-reply agreement
+        self.keys = StringArena.from_strings(keys)
+        self.replies = StringArena.from_strings(replies)
+        self._intern_replies(norms)
+        # vectorize the replies too so we can measure reply-to-reply agreement;
+        # idf counts every row, but each distinct reply is only stored once
+        key_fit = self._fit_union(keys, pool)
+        reply_fit = self._fit_union(norms, pool, transform=list(self.reply_vocab))
+        del norms
+        self.token_vocab = {}
+        self.features, secs = _timed(PairFeatures.build, keys, replies, self.token_vocab)
+        _log_stage("pair features", secs)
+        del keys, replies
+        self.vectorizer, self.matrix = key_fit()
+        self.postings, self.row_norms = self._posting_view(self.matrix)
         try:
-            self.reply_vectorizer = self._build_vectorizer()
-            self.reply_matrix = self.reply_vectorizer.fit_transform(self.reply_norms)
+            self.reply_vectorizer, self.reply_matrix = reply_fit()
         except Exception as e:  # pragma: no cover - defensive (tiny corpora)
             print(f"[brain] reply-space disabled: {e}", file=sys.stderr)
             self.reply_vectorizer = None
             self.reply_matrix = None
+        threads = ThreadPoolExecutor(max_workers=_build_workers()) if pool else None
+        try:
+            lsa = _submit(threads, _timed, self._fit_lsa)
+            self.reply_graph = None
+            if self.reply_matrix is not None and REPLY_GRAPH_K > 0:
+                self.reply_graph, secs = _timed(ReplyGraph.build, l2_normalize(self.reply_matrix), executor=threads)
+                _log_stage("reply graph", secs)
+            _log_stage("lsa", lsa.result()[1])
+        finally:
+            if threads:
+                threads.shutdown()
+        self.cache.clear()
+
+    def _fit_union(self, docs: List[str], pool: Optional[Executor],
+                   transform: Optional[List[str]] = None) -> Callable[[], tuple]:
+        """Start fitting a fresh vectorizer on ``docs``, one job per union
+        part. Returns a callable that waits for the parts and returns the
+        fitted (vectorizer, matrix), as ``FeatureUnion.fit_transform`` would;
+        with ``transform``, the matrix holds those documents instead."""
+        union = self._build_vectorizer(self.feature_mode, self.hash_buckets)
+        parts = [_submit(pool, _timed, _fit_transform_part, part, docs, transform)
+                 for _, part in union.transformer_list]
+
+        def result():
+            fitted = []
+            for (name, _), job in zip(union.transformer_list, parts):
+                (part, matrix), secs = job.result()
+                _log_stage(f"tf-idf {name} ({len(docs)} docs)", secs)
+                fitted.append((name, part, matrix))
+            union.transformer_list = [(name, part) for name, part, _ in fitted]
+            return union, sparse.hstack([m for _, _, m in fitted]).tocsr()
+
+        return result
+
+    def _intern_replies(self, reply_norms: List[str]):
+        self.reply_vocab = StringArena()
+        self._reply_index = {}
+        self.reply_ids = np.zeros(0, dtype=np.int32)
+        self.reply_freq = np.zeros(0, dtype=np.int64)
+        self._add_replies(reply_norms)
+        self.reply_vocab = self.reply_vocab.packed()
+        # only live ingestion needs the reverse map; rebuilt on demand
+        self._reply_index = None
+
+    @property
+    def reply_index(self) -> Dict[str, int]:
+        if self._reply_index is None:
+            self._reply_index = {nr: i for i, nr in enumerate(self.reply_vocab)}
+        return self._reply_index
+
+    def _add_replies(self, reply_norms: List[str]) -> List[str]:
+        """Append rows answering with ``reply_norms``; returns the replies
+        that were not interned yet (in id order)."""
+        first = len(self.reply_vocab)
+        index = self.reply_index
+        fresh: List[str] = []
+        ids = np.empty(len(reply_norms), dtype=np.int32)
+        for k, nr in enumerate(reply_norms):
+            rid = index.get(nr)
+            if rid is None:
+                rid = index[nr] = first + len(fresh)
+                fresh.append(nr)
+            ids[k] = rid
+        self.reply_vocab.extend(fresh)
+        freq = np.zeros(len(self.reply_vocab), dtype=np.int64)
+        freq[:first] = self.reply_freq
+        np.add.at(freq, ids, 1)
+        self.reply_ids = np.concatenate([self.reply_ids, ids])
+        self.reply_freq = freq
+        return fresh
+
+    def reply_norm(self, i: int) -> str:
+        return self.reply_vocab[self.reply_ids[i]]
+
+    def _set_lsa_columns(self, columns: Optional[np.ndarray]):
+        self.lsa_columns = columns
+        self._lsa_column_map = None
+        if columns is not None:
+            self._lsa_column_map = np.full(self.matrix.shape[1], -1, dtype=np.int64)
+            self._lsa_column_map[columns] = np.arange(columns.size)
+
+    def _lsa_transform(self, vecs) -> np.ndarray:
+        """Unit-length LSA rows of TF-IDF rows ``vecs``."""
+        if self._lsa_column_map is not None:
+            # keep the fitted columns only (an O(nnz) remap, not a column slice)
+            vecs = sparse.csr_matrix(vecs).tocoo()
+            cols = self._lsa_column_map[vecs.col]
+            keep = cols >= 0
+            vecs = sparse.csr_matrix(
+                (vecs.data[keep], (vecs.row[keep], cols[keep])), shape=(vecs.shape[0], self.lsa_columns.size),
+            )
+        return l2_normalize(self.svd.transform(vecs))
 
     def _fit_lsa(self):
         self.svd = None
+        self._set_lsa_columns(None)
         self.lsa_matrix = None
+        self.lsa_index = None
         if self.matrix is None:
             return
-        n_samples, n_features = self.matrix.shape
+        matrix = self.matrix
+        if self.feature_mode == "hashed":
+            # postings are column-major: column nnz is the bucket's df
+            used = np.flatnonzero(np.diff(self.postings.indptr))
+            self._set_lsa_columns(used)
+            matrix = self.postings[:, used].tocsr()
+        n_samples, n_features = matrix.shape
         if n_samples < LSA_MIN_PAIRS or n_features < 2:
             return
         # TruncatedSVD needs n_components < n_features and <= n_samples.
@@ -341,213 +1714,1243 @@ class CorpusRetriever:
             return
         try:
             self.svd = TruncatedSVD(n_components=n_comp, random_state=42)
-            dense = self.svd.fit_transform(self.matrix)
+            dense = self.svd.fit_transform(matrix)
             self.lsa_matrix = l2_normalize(dense)
         except Exception as e:  # pragma: no cover - defensive
             print(f"[brain] LSA fit failed, using TF-IDF only: {e}", file=sys.stderr)
             self.svd = None
+            self._set_lsa_columns(None)
             self.lsa_matrix = None
+            return
+        if n_samples >= LSA_ANN_MIN_ROWS:
+            self.lsa_index = LsaIndex.build(self.lsa_matrix)
 
-    def _query_sims(self, text: str) -> np.ndarray:
-        if self.vectorizer is None or self.matrix is None:
-            return np.array([])
-        q = canon(text)
-        if not q:
-            return np.array([])
-        vec = self.vectorizer.transform([q])
-        tfidf_sims = cosine_similarity(vec, self.matrix).flatten()
+    @staticmethod
+    def _posting_view(matrix) -> Tuple[sparse.csc_matrix, np.ndarray]:
+        matrix = sparse.csr_matrix(matrix)
+        squared = sparse.csr_matrix((np.square(matrix.data), matrix.indices, matrix.indptr), shape=matrix.shape)
+        return sparse.csc_matrix(matrix), np.sqrt(np.asarray(squared.sum(axis=1)).ravel())
+
+    def _lexical_matrix(self, vecs) -> sparse.csr_matrix:
+        """TF-IDF cosines of (m x F) query rows against the corpus as an
+        (m x rows) sparse matrix, from the posting lists of the main
+        segment plus the delta segment."""
+        sims = _posting_cosines(vecs, *self._postings())
+        if self.delta_matrix is not None:
+            sims = sparse.hstack([sims, self._delta_lexical(vecs)], format="csr")
+        return sims
+
+    def _delta_lexical(self, vecs) -> sparse.csr_matrix:
+        # the delta segment is small; a dense pass over it is cheap
+        return sparse.csr_matrix(cosine_similarity(vecs, self.delta_matrix))
+
+    def _semantic_matrix(self, vecs, probes: int) -> sparse.csr_matrix:
+        """LSA cosines of (m x F) query rows, restricted per query to the
+        rows its ``probes`` nearest IVF cells hold (every row when there is
+        no index or ``probes`` is 0)."""
+        lsa_vecs = self._lsa_transform(vecs)
+        sims = _lsa_cosines(lsa_vecs, self.lsa_matrix, self.lsa_index, probes)
+        if self.delta_lsa is not None:
+            sims = sparse.hstack([sims, sparse.csr_matrix(lsa_vecs.dot(self.delta_lsa.T))], format="csr")
+        return sims
+
+    def _query_matrix(self, queries: List[str], probes: Optional[int] = None) -> sparse.csr_matrix:
+        """Similarity of each canonical query to the corpus, one row per
+        query: a single transform, one sparse product for the lexical part
+        and one SVD transform for the queries that need the LSA net."""
+        t = time.perf_counter()
+        vecs = self.vectorizer.transform(queries)
+        t = STATS.lap("transform", t)
+        sims = self._lexical_matrix(vecs)
+        t = STATS.lap("tfidf", t)
+        STATS.count("queries", len(queries))
         if self.svd is None or self.lsa_matrix is None:
-            return tfidf_sims
+            return sims
         # LSA is a SAFETY NET, not the primary signal. When a strong lexical
         # match exists, trust it completely so exact matches stay perfect.
         # Only when lexical retrieval is weak do we let semantic similarity
         # ADD a boost to related-but-differently-worded candidates (it can
         # never drag a lexical score down).
-        if tfidf_sims.size and tfidf_sims.max() >= LSA_LEXICAL_TRUST:
-            return tfidf_sims
-        lsa_vec = l2_normalize(self.svd.transform(vec))
-        lsa_sims = cosine_similarity(lsa_vec, self.lsa_matrix).flatten()
-        return tfidf_sims + (lsa_sims * LSA_WEIGHT)
+        best = sims.max(axis=1).toarray().ravel()
+        weak = np.flatnonzero(best < LSA_LEXICAL_TRUST)
+        if weak.size == 0:
+            return sims
+        STATS.count("lsa", weak.size)
+        sims = _with_semantic(sims, weak, self._semantic_matrix(vecs[weak], self.lsa_probes if probes is None else probes))
+        STATS.lap("lsa", t)
+        return sims
 
-    def top_candidates(self, text: str, context: Optional[List[str]] = None, limit: int = 30) -> List[dict]:
-        if self.vectorizer is None or self.matrix is None:
-            return []
+    def lsa_recall(self, queries: List[str], k: int = 40, probes: int = LSA_PROBES) -> Tuple[float, float, float, int]:
+        """Recall@k of the IVF semantic path against the exact dense pass,
+        over the queries that actually fall through to LSA. Returns
+        (recall, exact ms/query, approximate ms/query, queries used)."""
+        if self.svd is None or self.lsa_matrix is None:
+            return 0.0, 0.0, 0.0, 0
+        hits, exact_s, approx_s, used = 0, 0.0, 0.0, 0
+        for text in queries:
+            q = canon(text)
+            if not q:
+                continue
+            if self._lexical_matrix(self.vectorizer.transform([q])).max() >= LSA_LEXICAL_TRUST:
+                continue
+            t0 = time.perf_counter()
+            exact = self._query_matrix([q], probes=0).toarray().ravel()
+            t1 = time.perf_counter()
+            approx = self._query_matrix([q], probes=probes).data
+            t2 = time.perf_counter()
+            # score-based so that ties at the k-th place don't count as misses
+            # (an approximate hit carries its exact score)
+            top = min(k, exact.size)
+            kth = np.sort(exact)[-top]
+            got = np.sort(approx)[::-1][:k]
+            hits += float(np.sum(got >= kth - 1e-12)) / top
+            exact_s += t1 - t0
+            approx_s += t2 - t1
+            used += 1
+        if not used:
+            return 0.0, 0.0, 0.0, 0
+        return hits / used, exact_s * 1000 / used, approx_s * 1000 / used, used
+
+    @staticmethod
+    def _query_variants(text: str, context: Optional[List[str]]) -> Tuple[List[str], List[float]]:
+        """Canonical query variants and their blend weights: weighted
+        multi-query instead of one mushy concatenated blob."""
+        q = canon(text)
+        if not q:
+            return [], []
         context = context or []
-        if not canon(text):
-            return []
-        sims = self._query_sims(text)
-        if sims.size == 0:
-            return []
-        # weighted multi-query instead of one mushy concatenated blob
-        if context:
-            prev1 = context[0] if len(context) >= 1 else ""
-            prev2 = context[1] if len(context) >= 2 else ""
-            if prev1:
-                s1 = self._query_sims(f"{prev1} {text}".strip())
-                if s1.size == sims.size:
-                    sims = (sims * 0.80) + (s1 * 0.20)
-            if prev2 and prev1:
-                s2 = self._query_sims(f"{prev2} {prev1} {text}".strip())
-                if s2.size == sims.size:
-                    sims = (sims * 0.95) + (s2 * 0.05)
-        order = np.argsort(sims)[::-1][:limit]
-        out = []
-        for i in order:
-            if sims[i] <= 0:
+        queries, weights = [q], [1.0]
+        prev1 = context[0] if len(context) >= 1 else ""
+        prev2 = context[1] if len(context) >= 2 else ""
+        if prev1:
+            queries.append(canon(f"{prev1} {text}".strip()))
+            weights = [0.80, 0.20]
+        if prev2 and prev1:
+            queries.append(canon(f"{prev2} {prev1} {text}".strip()))
+            weights = [w * 0.95 for w in weights] + [0.05]
+        return queries, weights
+
+    def lookup(self, text: str, context: Optional[List[str]] = None, limit: int = 30) -> Optional[CandidateSet]:
+        """The ``limit`` best matches of ``text`` in its ``context`` (with
+        their reply consensus) as a shared, read-only CandidateSet, served
+        from the cache when the same canonical query/context was seen
+        recently. None if nothing matched."""
+        t = time.perf_counter()
+        queries, weights = self._query_variants(text, context)
+        STATS.lap("canon", t)
+        if not queries or self.vectorizer is None or self.matrix is None:
+            return None
+        key = (tuple(queries), limit)
+        cached = self.cache.get(key)
+        if cached is not None:
+            STATS.count("cache_hits")
+            return cached
+        STATS.count("cache_misses")
+        generation = self.cache.generation
+        cands = self._candidate_set(*self._rank(queries, weights, limit))
+        self.cache.put(key, cands, generation)
+        return cands
+
+    def lookup_batch(self, requests: List[Tuple[str, Optional[List[str]]]], limit: int = 30) -> List[Optional[CandidateSet]]:
+        """``lookup`` for many (text, context) requests at once. The cache
+        misses share one transform, one sparse product against the corpus
+        and one LSA pass over the weak-lexical queries among them; repeated
+        requests are computed once."""
+        if self.vectorizer is None or self.matrix is None:
+            return [None] * len(requests)
+        keys: List[Optional[tuple]] = []
+        found: Dict[tuple, Optional[CandidateSet]] = {}
+        pending: Dict[tuple, List[float]] = {}
+        for text, context in requests:
+            t = time.perf_counter()
+            queries, weights = self._query_variants(text, context)
+            STATS.lap("canon", t)
+            key = (tuple(queries), limit) if queries else None
+            keys.append(key)
+            if key is None or key in found or key in pending:
                 continue
-            out.append({
-                "idx": int(i),
-                "parent": self.keys[i],
-                "reply": self.replies[i],
-                "reply_norm": self.reply_norms[i],
-                "sim": float(sims[i]),
-                "freq": self.reply_freq[self.reply_norms[i]],
-            })
+            cached = self.cache.get(key)
+            if cached is not None:
+                found[key] = cached
+            else:
+                pending[key] = weights
+        STATS.count("cache_hits", len(found))
+        STATS.count("cache_misses", len(pending))
+        if pending:
+            generation = self.cache.generation
+            groups = [(list(key[0]), weights) for key, weights in pending.items()]
+            ranked = self._scatter(groups, limit) if self.shards is not None else None
+            if ranked is None:
+                ranked = self._rank_batch(groups, limit)
+            for key, (ids, sims) in zip(pending, ranked):
+                cands = self._candidate_set(ids, sims)
+                self.cache.put(key, cands, generation)
+                found[key] = cands
+        return [None if key is None else found[key] for key in keys]
+
+    def _rank_batch(self, groups: List[Tuple[List[str], List[float]]], limit: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """``_rank`` for each (queries, weights) group, all queries in one
+        ``_query_matrix`` call."""
+        flat = [q for queries, _ in groups for q in queries]
+        sims = self._query_matrix(flat)
+        # groups with context variants: one blended row each, their
+        # variants' rows weighted (the same product _rank does alone)
+        blended = [g for g, (queries, _) in enumerate(groups) if len(queries) > 1]
+        starts = np.cumsum([0] + [len(queries) for queries, _ in groups])
+        mix = None
+        if blended:
+            cols = np.concatenate([np.arange(starts[g], starts[g + 1]) for g in blended])
+            rows = np.repeat(np.arange(len(blended)), [len(groups[g][0]) for g in blended])
+            vals = np.concatenate([groups[g][1] for g in blended])
+            mix = sparse.csr_matrix((vals, (rows, cols)), shape=(len(blended), len(flat))).dot(sims)
+        slot = {g: i for i, g in enumerate(blended)}
+        out = []
+        for g in range(len(groups)):
+            matrix, row = (mix, slot[g]) if g in slot else (sims, starts[g])
+            lo, hi = matrix.indptr[row], matrix.indptr[row + 1]
+            out.append(self._top(matrix.indices[lo:hi].astype(np.int64), matrix.data[lo:hi], limit))
         return out
 
-    def reply_consensus(self, cands: List[dict]) -> np.ndarray:
-        """For each candidate, how strongly the rest of the retrieved
-        neighbourhood AGREES with its reply (similarity-weighted).
+    def _scatter(self, groups: List[Tuple[List[str], List[float]]], limit: int) -> Optional[List[Tuple[np.ndarray, np.ndarray]]]:
+        """``_rank_batch`` through the shards: the queries are vectorized
+        here once, every shard returns its top ``limit`` per group and the
+        lists (plus the delta segment, searched here meanwhile) merge into
+        the global top. None if the shards failed; they are dropped and the
+        caller searches in-process."""
+        shards = self.shards
+        flat = [q for queries, _ in groups for q in queries]
+        sizes = [len(queries) for queries, _ in groups]
+        mix = sparse.csr_matrix(
+            (np.concatenate([weights for _, weights in groups]), (np.repeat(np.arange(len(groups)), sizes), np.arange(len(flat)))),
+            shape=(len(groups), len(flat)),
+        )
+        t = time.perf_counter()
+        vecs = sparse.csr_matrix(self.vectorizer.transform(flat))
+        t = STATS.lap("transform", t)
+        STATS.count("queries", len(flat))
+        try:
+            with shards.lock:
+                try:
+                    parts, tail = self._scatter_call(shards, vecs, mix, limit, t)
+                except (EOFError, OSError) as e:
+                    # a dead shard: start it again and repeat the call once
+                    if not shards.revive():
+                        raise
+                    print(f"[brain] restarted a dead retrieval shard ({e})", file=sys.stderr)
+                    parts, tail = self._scatter_call(shards, vecs, mix, limit, t)
+        except (EOFError, OSError, RuntimeError) as e:
+            if self.shards is shards:
+                print(f"[brain] retrieval shards failed, searching in-process: {e}", file=sys.stderr)
+                self.stop_shards()
+            return None
+        if tail is not None:
+            parts.append(_mixed_tops(tail, mix, self.matrix.shape[0], limit))
+        out = []
+        for g in range(len(groups)):
+            ids = np.concatenate([tops[g][0] for tops in parts])
+            sims = np.concatenate([tops[g][1] for tops in parts])
+            out.append(self._top(ids, sims, limit))
+        return out
 
-        Generalizes exact-duplicate consensus to near-duplicate replies, so
-        the answer the crowd converges on gets boosted even when worded
-        differently. Returns an array aligned with ``cands``.
-        """
-        n = len(cands)
-        if n == 0:
+    def _scatter_call(self, shards: RetrievalShards, vecs, mix: sparse.csr_matrix, limit: int,
+                      t: float) -> Tuple[list, Optional[sparse.csr_matrix]]:
+        """One ``_scatter`` round trip (with ``shards.lock`` held): the
+        shards' top lists and the delta segment's similarities."""
+        shards.scatter(("lexical", vecs, mix, limit))
+        tail = None if self.delta_matrix is None else self._delta_lexical(vecs)
+        answers = shards.gather()
+        t = STATS.lap("tfidf", t)
+        parts = [tops for _, tops in answers]
+        # the LSA net decision needs the best lexical match over ALL rows
+        best = np.max([b for b, _ in answers] + ([] if tail is None else [tail.max(axis=1).toarray().ravel()]), axis=0)
+        weak = np.zeros(0, dtype=np.int64)
+        if self.svd is not None and self.lsa_matrix is not None:
+            weak = np.flatnonzero(best < LSA_LEXICAL_TRUST)
+        if weak.size:
+            STATS.count("lsa", weak.size)
+            lsa_vecs = self._lsa_transform(vecs[weak])
+            shards.scatter(("semantic", weak, lsa_vecs, self.lsa_probes, mix, limit))
+            if tail is not None and self.delta_lsa is not None:
+                tail = _with_semantic(tail, weak, sparse.csr_matrix(lsa_vecs.dot(self.delta_lsa.T)))
+            parts = shards.gather()
+            STATS.lap("lsa", t)
+        return parts, tail
+
+    def start_shards(self, count: int):
+        """Search the main segment through ``count`` shard processes from
+        now on (1 = in-process)."""
+        self.stop_shards()
+        if count > 1 and self.matrix is not None and self.matrix.shape[0] >= count:
+            self.shards = RetrievalShards.start(self.matrix, self.lsa_matrix, self.lsa_index, count)
+            # the shards search their own posting views; this one is only
+            # rebuilt if they fail for good (``_postings``)
+            self.postings = self.row_norms = None
+
+    def _postings(self) -> Tuple[sparse.csc_matrix, np.ndarray]:
+        """The main segment's posting view, rebuilt if released for shards."""
+        if self.postings is None:
+            self.postings, self.row_norms = self._posting_view(self.matrix)
+        return self.postings, self.row_norms
+
+    def stop_shards(self):
+        shards, self.shards = self.shards, None
+        if shards is not None:
+            shards.close()
+
+    def _candidate_set(self, ids: np.ndarray, sims: np.ndarray) -> Optional[CandidateSet]:
+        if not ids.size:
+            return None
+        reply = self.reply_ids[ids]
+        uniq, group = np.unique(reply, return_inverse=True)
+        t = time.perf_counter()
+        consensus = self._consensus(ids, sims)
+        STATS.lap("consensus", t)
+        return CandidateSet(
+            ids, sims, self.reply_freq[reply], group,
+            [self.reply_vocab[r] for r in uniq.tolist()], self._take_features(ids), consensus,
+        )
+
+    def _rank(self, queries: List[str], weights: List[float], limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Row ids and blended similarities of the ``limit`` best positive
+        matches, best first (ties by row id)."""
+        if self.shards is not None:
+            ranked = self._scatter([(queries, weights)], limit)
+            if ranked is not None:
+                return ranked[0]
+        sims = self._query_matrix(queries)
+        if len(queries) > 1:
+            sims = sparse.csr_matrix(np.asarray(weights)[None, :]).dot(sims)
+        return self._top(sims.indices.astype(np.int64), sims.data, limit)
+
+    @staticmethod
+    def _top(ids: np.ndarray, sims: np.ndarray, limit: int) -> Tuple[np.ndarray, np.ndarray]:
+        positive = sims > 0
+        ids, sims = ids[positive], sims[positive]
+        if ids.size > limit:
+            # partial selection: only the top ``limit`` get sorted. Rows tied
+            # with the last place are cut by row id, not by wherever the
+            # partition left them, so the result doesn't depend on the order
+            # of the input (a batch row vs a single query's row)
+            kth = -np.partition(-sims, limit - 1)[limit - 1]
+            above = np.flatnonzero(sims > kth)
+            tied = np.flatnonzero(sims == kth)
+            tied = tied[np.argsort(ids[tied], kind="stable")[:limit - above.size]]
+            top = np.concatenate([above, tied])
+            ids, sims = ids[top], sims[top]
+        order = np.lexsort((ids, -sims))
+        # scoring is float64 whatever the matrices are stored as
+        return ids[order], sims[order].astype(np.float64)
+
+    def _take_features(self, idxs: np.ndarray) -> PairFeatures:
+        n_main = len(self.features)
+        if self.delta_features is None or not (idxs >= n_main).any():
+            return self.features.take(idxs)
+        in_main = idxs < n_main
+        stacked = PairFeatures.concat(
+            self.features.take(idxs[in_main]),
+            self.delta_features.take(idxs[~in_main] - n_main),
+        )
+        # restore candidate order (main rows were stacked first)
+        order = np.concatenate([np.flatnonzero(in_main), np.flatnonzero(~in_main)])
+        return stacked.take(np.argsort(order, kind="stable"))
+
+    def query_features(self, text: str) -> dict:
+        """Per-request counterpart of ``PairFeatures`` for the user input."""
+        tokens = _canon_token_set(text)
+        ids = {self.token_vocab[t] for t in tokens if t in self.token_vocab}
+        return {
+            "token_array": np.array(sorted(ids), dtype=np.int64),
+            "n_tokens": len(tokens),
+            "len": len(tokenize(text)),
+            "question": is_question(text),
+        }
+
+    def _consensus(self, idxs: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        if idxs.size == 0:
             return np.zeros(0)
+        # pool the weight of exact duplicates onto their reply
+        nodes, inv = np.unique(self.reply_ids[idxs], return_inverse=True)
+        mass = np.bincount(inv, weights=weights)
         if self.reply_matrix is None:
             # fall back to exact-duplicate agreement
-            support: Dict[str, float] = defaultdict(float)
-            for c in cands:
-                support[c["reply_norm"]] += c["sim"]
-            return np.array([support[c["reply_norm"]] for c in cands])
-        idxs = [c["idx"] for c in cands]
-        weights = np.array([c["sim"] for c in cands])
-        sub = self.reply_matrix[idxs]
-        sim = cosine_similarity(sub)          # n x n reply-to-reply similarity
-        return sim.dot(weights)               # neighbour-weighted agreement
+            return mass[inv]
+        if self.reply_graph is None:
+            vecs = l2_normalize(self._reply_rows(nodes))
+            return vecs.dot(vecs.T).toarray().dot(mass)[inv]
+        known = nodes < self.reply_graph.nodes
+        sim = np.zeros((nodes.size, nodes.size))
+        sim[np.ix_(known, known)] = self.reply_graph.block(nodes[known])
+        np.fill_diagonal(sim, 1.0)
+        if not known.all():
+            # replies first seen in the delta segment are not in the graph yet
+            vecs = l2_normalize(self._reply_rows(nodes))
+            fresh = vecs[~known].dot(vecs.T).toarray()
+            fresh[fresh < REPLY_GRAPH_MIN_SIM] = 0.0
+            sim[~known] = fresh
+            sim[:, ~known] = fresh.T
+        return sim.dot(mass)[inv]             # neighbour-weighted agreement
+
+    def _reply_rows(self, reply_ids: np.ndarray):
+        n_main = self.reply_matrix.shape[0]
+        if self.delta_reply_matrix is None or not (reply_ids >= n_main).any():
+            return self.reply_matrix[reply_ids]
+        in_main = reply_ids < n_main
+        stacked = sparse.vstack([
+            self.reply_matrix[reply_ids[in_main]],
+            self.delta_reply_matrix[reply_ids[~in_main] - n_main],
+        ], format="csr")
+        # restore candidate order (main rows were stacked first)
+        order = np.concatenate([np.flatnonzero(in_main), np.flatnonzero(~in_main)])
+        return stacked[np.argsort(order, kind="stable")]
+
+    # --- live delta segment -----------------------------------------------
+
+    @property
+    def delta_rows(self) -> int:
+        return 0 if self.delta_matrix is None else self.delta_matrix.shape[0]
+
+    def add(self, keys: List[str], replies: List[str]) -> int:
+        """Append pairs to the delta segment using the already-fitted
+        vectorizers (with a vocabulary, unseen n-grams simply don't count
+        until the next full fit). Returns the number of rows added."""
+        if self.vectorizer is None or self.matrix is None:
+            return 0
+        cleaned = []
+        for k, r in zip(keys, replies):
+            ck = canon(k)
+            nr = normalize(r)
+            if ck and nr:
+                cleaned.append((ck, r, nr))
+        if not cleaned:
+            return 0
+        new_keys = [k for k, _, _ in cleaned]
+        new_replies = [r for _, r, _ in cleaned]
+        new_norms = [nr for _, _, nr in cleaned]
+        features = PairFeatures.build(new_keys, new_replies, self.token_vocab)
+        vec = self.vectorizer.transform(new_keys)
+        lsa = self._lsa_transform(vec) if self.svd is not None else None
+        fresh = self._add_replies(new_norms)
+        reply_vec = None
+        if self.reply_vectorizer is not None and fresh:
+            reply_vec = self.reply_vectorizer.transform(fresh)
+        self.keys.extend(new_keys)
+        self.replies.extend(new_replies)
+        self.delta_features = features if self.delta_features is None else PairFeatures.concat(self.delta_features, features)
+        if reply_vec is not None:
+            self.delta_reply_matrix = self._stack(self.delta_reply_matrix, reply_vec)
+        self.delta_lsa = None if lsa is None else (lsa if self.delta_lsa is None else np.vstack([self.delta_lsa, lsa]))
+        self.delta_matrix = self._stack(self.delta_matrix, vec)
+        self.cache.clear()
+        return len(cleaned)
+
+    @staticmethod
+    def _stack(a, b):
+        if b is None:
+            return None
+        return b if a is None else sparse.vstack([a, b], format="csr")
+
+    def merged_segments(self) -> Optional[dict]:
+        """Main + delta folded into new main matrices (no refit). Built
+        without touching live state; hand the result to ``install``."""
+        if self.delta_matrix is None:
+            return None
+        matrix = self._stack(self.matrix, self.delta_matrix)
+        shards = self.shards
+        # sharded, the posting view is the shards' (see ``start_shards``)
+        postings, row_norms = (None, None) if shards is not None else self._posting_view(matrix)
+        reply_matrix = self.reply_matrix
+        reply_graph = self.reply_graph
+        if self.delta_reply_matrix is not None:
+            reply_matrix = self._stack(reply_matrix, self.delta_reply_matrix)
+            if reply_graph is not None:
+                reply_graph = reply_graph.extend(l2_normalize(reply_matrix))
+        lsa_matrix = None if self.lsa_matrix is None else np.vstack([self.lsa_matrix, self.delta_lsa])
+        lsa_index = None if self.lsa_index is None else self.lsa_index.extend(self.delta_lsa)
+        return {
+            "matrix": matrix,
+            "postings": postings,
+            "row_norms": row_norms,
+            "lsa_index": lsa_index,
+            "lsa_matrix": lsa_matrix,
+            "reply_matrix": reply_matrix,
+            "reply_graph": reply_graph,
+            "features": PairFeatures.concat(self.features, self.delta_features),
+            # the old shards keep serving until the swap
+            "shards": None if shards is None else RetrievalShards.start(matrix, lsa_matrix, lsa_index, shards.count),
+            "delta_matrix": self.delta_matrix,
+        }
+
+    def install(self, merged: dict) -> bool:
+        """Swap in ``merged_segments`` output, unless the delta changed
+        (or the retriever was refitted) in the meantime."""
+        if merged["delta_matrix"] is not self.delta_matrix:
+            if merged["shards"] is not None:
+                merged["shards"].close()
+            return False
+        old_shards, self.shards = self.shards, merged["shards"]
+        self.matrix = merged["matrix"]
+        self.postings, self.row_norms = merged["postings"], merged["row_norms"]
+        self.lsa_matrix = merged["lsa_matrix"]
+        self.lsa_index = merged["lsa_index"]
+        self.reply_matrix = merged["reply_matrix"]
+        self.reply_graph = merged["reply_graph"]
+        self.features = merged["features"]
+        self._reset_delta()
+        self.cache.clear()
+        if old_shards is not None:
+            old_shards.close()
+        return True
+
+    # --- on-disk snapshot -------------------------------------------------
+    # Layout of ``path``: meta.json (format, DB stamp, shapes), one .npy per
+    # CSR component / dense matrix (memory-mapped on load), pickled fitted
+    # vectorizers (vocabulary or hashing params + idf) and the row strings as
+    # UTF-8 arenas (mapped as well).
+
+    def fingerprint(self) -> str:
+        """Hash of everything that shapes the fitted state besides the DB rows
+        themselves, so a config or library change invalidates a snapshot."""
+        src = json.dumps([
+            sklearn.__version__, repr(self._build_vectorizer(self.feature_mode, self.hash_buckets)),
+            LSA_COMPONENTS, LSA_MIN_PAIRS, LSA_ANN_MIN_ROWS, REPLY_GRAPH_K, REPLY_GRAPH_MIN_SIM, DIALECT_MAP,
+            RESPONSE_BLACKLIST, _SPAM_RE.pattern,
+        ], sort_keys=True)
+        return hashlib.sha1(src.encode("utf-8")).hexdigest()[:16]
+
+    def save(self, path: str, stamp: dict):
+        if self.vectorizer is None or self.matrix is None:
+            return
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        meta = {"format": INDEX_FORMAT, "stamp": stamp, "rows": len(self.keys), "sparse": {}}
+        graph = None if self.reply_graph is None else self.reply_graph.edges
+        # not kept: a sharded retriever doesn't hold its posting view
+        postings, row_norms = (self.postings, self.row_norms) if self.postings is not None else self._posting_view(self.matrix)
+        for name, fmt, m in (
+            ("matrix", "csr", self.matrix), ("postings", "csc", postings),
+            ("reply_matrix", "csr", self.reply_matrix), ("reply_graph", "csr", graph),
+        ):
+            if m is None:
+                continue
+            m = m.asformat(fmt)
+            for part in ("data", "indices", "indptr"):
+                np.save(os.path.join(tmp, f"{name}.{part}.npy"), getattr(m, part))
+            meta["sparse"][name] = [fmt, list(m.shape)]
+        np.save(os.path.join(tmp, "row_norms.npy"), row_norms)
+        if self.svd is not None and self.lsa_matrix is not None:
+            np.save(os.path.join(tmp, "lsa_matrix.npy"), self.lsa_matrix)
+            np.save(os.path.join(tmp, "svd_components.npy"), self.svd.components_)
+            if self.lsa_columns is not None:
+                np.save(os.path.join(tmp, "lsa_columns.npy"), self.lsa_columns)
+            # the components are stored (and mmapped) separately
+            svd = copy.copy(self.svd)
+            svd.components_ = None
+            with open(os.path.join(tmp, "svd.pkl"), "wb") as f:
+                pickle.dump(svd, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.lsa_index is not None:
+                for part in ("centroids", "cell_rows", "cell_offsets"):
+                    np.save(os.path.join(tmp, f"lsa_index.{part}.npy"), getattr(self.lsa_index, part))
+        for col in PairFeatures.COLUMNS:
+            np.save(os.path.join(tmp, f"features.{col}.npy"), getattr(self.features, col))
+        with open(os.path.join(tmp, "token_vocab.json"), "w", encoding="utf-8") as f:
+            # ids are list positions
+            json.dump(sorted(self.token_vocab, key=self.token_vocab.get), f, ensure_ascii=False)
+        with open(os.path.join(tmp, "vectorizers.pkl"), "wb") as f:
+            pickle.dump((self.vectorizer, self.reply_vectorizer), f, protocol=pickle.HIGHEST_PROTOCOL)
+        for name in ("keys", "replies", "reply_vocab"):
+            getattr(self, name).save(os.path.join(tmp, name))
+        np.save(os.path.join(tmp, "reply_ids.npy"), self.reply_ids)
+        _commit_snapshot(tmp, path, meta)
+
+    def load(self, path: str, stamp: dict) -> bool:
+        """Adopt the snapshot at ``path`` if it was built from ``stamp``.
+        Returns False (leaving the current state untouched) otherwise."""
+        meta = _snapshot_meta(path)
+        if meta.get("format") != INDEX_FORMAT or meta.get("stamp") != stamp:
+            return False
+        try:
+            def npy(name):
+                return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+            mats = {}
+            for name, (fmt, shape) in meta["sparse"].items():
+                parts = (npy(f"{name}.data"), npy(f"{name}.indices"), npy(f"{name}.indptr"))
+                cls = sparse.csc_matrix if fmt == "csc" else sparse.csr_matrix
+                mats[name] = cls(parts, shape=tuple(shape), copy=False)
+            row_norms = npy("row_norms")
+            with open(os.path.join(path, "vectorizers.pkl"), "rb") as f:
+                vectorizer, reply_vectorizer = pickle.load(f)
+            svd, lsa_columns, lsa_matrix, lsa_index = None, None, None, None
+            if os.path.exists(os.path.join(path, "svd.pkl")):
+                with open(os.path.join(path, "svd.pkl"), "rb") as f:
+                    svd = pickle.load(f)
+                svd.components_ = npy("svd_components")
+                if os.path.exists(os.path.join(path, "lsa_columns.npy")):
+                    lsa_columns = npy("lsa_columns")
+                lsa_matrix = npy("lsa_matrix")
+                if os.path.exists(os.path.join(path, "lsa_index.centroids.npy")):
+                    lsa_index = LsaIndex(*(npy(f"lsa_index.{part}") for part in ("centroids", "cell_rows", "cell_offsets")))
+            keys, replies, reply_vocab = (
+                StringArena.load(os.path.join(path, name)) for name in ("keys", "replies", "reply_vocab")
+            )
+            reply_ids = npy("reply_ids")
+            features = PairFeatures(*(npy(f"features.{col}") for col in PairFeatures.COLUMNS))
+            with open(os.path.join(path, "token_vocab.json"), encoding="utf-8") as f:
+                token_vocab = {tok: i for i, tok in enumerate(json.load(f))}
+        except Exception as e:
+            print(f"[brain] snapshot at {path} unreadable, refitting: {e}", file=sys.stderr)
+            return False
+        matrix = mats.get("matrix")
+        postings = mats.get("postings")
+        reply_matrix = mats.get("reply_matrix")
+        reply_graph = ReplyGraph(mats["reply_graph"]) if "reply_graph" in mats else None
+        rows = meta["rows"]
+        n_features = self._n_features(vectorizer)
+        lsa_features = n_features if lsa_columns is None else lsa_columns.size
+        if (
+            matrix is None or matrix.shape != (rows, n_features)
+            or postings is None or postings.shape != matrix.shape or row_norms.shape != (rows,)
+            or not len(keys) == len(replies) == rows or reply_ids.shape != (rows,)
+            or any(a.offsets[-1] != a.data.size for a in (keys, replies, reply_vocab))
+            or (rows and not 0 <= reply_ids.min() <= reply_ids.max() < len(reply_vocab))
+            or (reply_matrix is not None and reply_matrix.shape[0] != len(reply_vocab))
+            or (reply_graph is not None and reply_graph.nodes != len(reply_vocab))
+            or (lsa_matrix is not None and (lsa_matrix.shape[0] != rows or svd.components_.shape[1] != lsa_features))
+            or (lsa_columns is not None and lsa_columns.size and lsa_columns.max() >= n_features)
+            or (lsa_index is not None and lsa_index.cell_rows.shape != (rows,))
+            or len(features) != rows or features.parent_ptr.shape != (rows + 1,)
+        ):
+            print(f"[brain] snapshot at {path} is inconsistent, refitting", file=sys.stderr)
+            return False
+        self.stop_shards()
+        self.keys, self.replies = keys, replies
+        self.reply_vocab = reply_vocab
+        self._reply_index = None
+        self.reply_ids = reply_ids
+        self.reply_freq = np.bincount(reply_ids, minlength=len(reply_vocab)).astype(np.int64)
+        self.reply_graph = reply_graph
+        self.vectorizer, self.matrix = vectorizer, matrix
+        self.postings, self.row_norms = postings, row_norms
+        self.svd, self.lsa_matrix, self.lsa_index = svd, lsa_matrix, lsa_index
+        self._set_lsa_columns(lsa_columns)
+        self.reply_vectorizer, self.reply_matrix = reply_vectorizer, reply_matrix
+        self.features, self.token_vocab = features, token_vocab
+        self._reset_delta()
+        self.cache.clear()
+        return True
+
+def _commit_snapshot(tmp: str, path: str, meta: dict):
+    """Write ``meta`` into the filled-in ``tmp`` dir and swap it in for
+    ``path``."""
+    # meta.json goes last: a snapshot without it is never considered valid
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    old = path + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    # a running process may still have the old files mapped; on POSIX the
+    # unlinked inodes stay alive until it drops them
+    shutil.rmtree(old, ignore_errors=True)
+
+def _snapshot_meta(path: str) -> dict:
+    try:
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _timed(fn: Callable, *args, **kwargs):
+    """``(fn(*args, **kwargs), seconds)``; module level so it pickles."""
+    t0 = time.perf_counter()
+    return fn(*args, **kwargs), time.perf_counter() - t0
+
+def _log_stage(name: str, secs: float):
+    print(f"[brain] build {name}: {secs:.2f}s", file=sys.stderr)
+
+def _submit(executor: Optional[Executor], fn: Callable, *args, **kwargs) -> Future:
+    """``executor.submit``, or run inline when there is no executor."""
+    if executor is not None:
+        return executor.submit(fn, *args, **kwargs)
+    job: Future = Future()
+    try:
+        job.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        job.set_exception(e)
+    return job
+
+def _build_workers() -> int:
+    return BUILD_WORKERS or os.cpu_count() or 1
+
+def _build_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """Process pool for a full build, or None to build in-process. Spawned
+    (not forked) workers, since serving threads may be running."""
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _fit_transform_part(part, docs: List[str], transform: Optional[List[str]] = None):
+    if transform is None:
+        return part, part.fit_transform(docs)
+    return part, part.fit(docs).transform(transform)
+
+def _prep_pairs(rows: List[Tuple[str, str]]) -> Tuple[List[str], List[str], List[str], List[str]]:
+    """One chunk of (parentKey, reply) rows -> retrievable (keys, replies,
+    norms) plus the replies worth keeping as fallbacks."""
+    keys, replies, norms, fallback = [], [], [], []
+    for k, r in rows:
+        if fallback_worthy(r):
+            fallback.append(r)
+        # drop scam/raid spam so it can never be retrieved or echoed
+        if not k or looks_spam(r) or looks_spam(k):
+            continue
+        ck = canon(k)
+        nr = normalize(r)
+        if ck and nr:
+            keys.append(ck)
+            replies.append(r)
+            norms.append(nr)
+    return keys, replies, norms, fallback
+
+def _fallback_of(rows: List[Tuple[str]]) -> List[str]:
+    """The fallback-worthy replies of one chunk of (reply,) rows."""
+    return [r for (r,) in rows if fallback_worthy(r)]
+
+def _train_markov(db_path: str, msg_mark: int) -> MarkovBrain:
+    """Markov chain over all non-spam messages up to ``msg_mark``, read on
+    its own connection so it can run in a worker."""
+    conn = HopfiBrain._connect(db_path)
+    markov = MarkovBrain()
+    markov.train(
+        m for (m,) in HopfiBrain._stream(conn.cursor(), "SELECT content FROM messages WHERE content != '' AND rowid <= ?", (msg_mark,))
+        if not looks_spam(m)
+    )
+    conn.close()
+    return markov
+
+def _map_chunks(executor: Optional[Executor], fn: Callable, rows: Iterable,
+               window: int = 1, size: int = LOAD_BATCH_ROWS) -> Iterator:
+    """``fn`` over consecutive chunks of ``rows``, results in order. At most
+    ``window`` chunks are in flight, so a streamed input stays streamed."""
+    pending: deque = deque()
+    chunk: list = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            pending.append(_submit(executor, fn, chunk))
+            chunk = []
+            if len(pending) >= window:
+                yield pending.popleft().result()
+    if chunk:
+        pending.append(_submit(executor, fn, chunk))
+    while pending:
+        yield pending.popleft().result()
 
 class HopfiBrain:
-    def __init__(self, db_path: str = DB_PATH):
+    def __init__(self, db_path: str = DB_PATH, index_dir: Optional[str] = INDEX_DIR, shards: int = RETRIEVAL_SHARDS):
+        self.index_dir = index_dir
+        self.shards = shards
         self.retriever = CorpusRetriever()
         self.markov = MarkovBrain()
         self.emojis = EmojiResolver()
         self._recent_raw: deque = deque(maxlen=15)
-        self._recent_norm: deque = deque(maxlen=15)
-        self._fallback_replies: List[str] = []
+        self._recent_norm = RecentWindow(maxlen=15)
+        # fallback bucket, plus per entry hash(normalize(reply)) and whether
+        # it is short, so picking one decodes a single string
+        self._fallback_replies = StringArena()
+        self._fallback_hash = np.zeros(0, dtype=np.int64)
+        self._fallback_short = np.zeros(0, dtype=bool)
+        # high-water marks (pairs.id / messages.rowid) of what has been
+        # trained or ingested so far; live ingestion polls above them
+        self._pair_mark = 0
+        self._msg_mark = 0
+        # (path, stamp) the installed retriever is saved under, if anywhere
+        self._snapshot: Tuple[Optional[str], Optional[dict]] = (None, None)
+        # serializes replies against ingestion/compaction/reload swaps
+        self._lock = threading.RLock()
+        self._reloading = False
+        self._profiling = False
+        # off in pre-forked workers: folding the delta in would give each
+        # worker a private copy of the main matrices (the dispatcher compacts
+        # and hands the result to all of them instead)
+        self.compact_delta = True
         self._load(db_path)
 
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        """Read-only connection (the JS learner owns writes) with the DB file
+        memory-mapped, so bulk scans read pages without copying them."""
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+        conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+        return conn
+
+    @staticmethod
+    def _stream(c: sqlite3.Cursor, sql: str, params: tuple = ()) -> Iterator[tuple]:
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(LOAD_BATCH_ROWS)
+            if not rows:
+                return
+            yield from rows
+
     def _load(self, db_path: str):
-        conn = sqlite3.connect(db_path)
+        self._install(self._build(db_path))
+
+    def _build(self, db_path: str) -> dict:
+        """Fit a complete retriever / markov / fallback set from the DB
+        without touching the live one, so it can run while serving."""
+        t0 = time.perf_counter()
+        with self._lock:
+            recent = set(self._recent_norm.hashes().tolist())
+        live = self.retriever
+        retriever = CorpusRetriever(feature_mode=live.feature_mode, hash_buckets=live.hash_buckets)
+        conn = self._connect(db_path)
         c = conn.cursor()
-        c.execute("SELECT parentKey, reply FROM pairs WHERE parentKey != '' AND reply != ''")
-        # drop scam/raid spam so it can never be retrieved or echoed
-        rows = [(k, r) for k, r in c.fetchall() if not looks_spam(r) and not looks_spam(k)]
-        keys, replies = zip(*rows) if rows else ([], [])
-        print(f"[brain] loading {len(keys)} pairs for retrieval…", file=sys.stderr)
-        self.retriever.train(list(keys), list(replies))
-        lsa = "on" if self.retriever.svd is not None else "off"
-        print(f"[brain] LSA semantic layer: {lsa}", file=sys.stderr)
-        c.execute("SELECT content FROM messages WHERE content != ''")
-        messages = [r[0] for r in c.fetchall() if not looks_spam(r[0])]
-        print(f"[brain] training markov on {len(messages)} messages…", file=sys.stderr)
-        self.markov.train(messages)
-        # learned fallback bucket from your own corpus
-        c.execute("SELECT reply FROM pairs WHERE reply != ''")
-        raw_replies = [r[0] for r in c.fetchall()]
-        self._fallback_replies = [
-            r for r in raw_replies
-            if self._quality_ok(r) and (looks_uncertain_reply(r) or looks_generic(r) or len(tokenize(r)) <= 5)
-        ]
+        stamp = self._db_stamp(c)
+        pair_mark = stamp["max_pair_id"]
+        msg_stamp = self._msg_stamp(c)
+        msg_mark = msg_stamp["max_rowid"]
+        mapped = bool(self.index_dir) and retriever.load(self.index_dir, stamp)
+        snapshot = self.index_dir if mapped else None
+        if mapped:
+            print(f"[brain] mapped snapshot of {len(retriever.keys)} pairs from {self.index_dir}", file=sys.stderr)
+        markov_dir = self.index_dir.rstrip("/\\") + ".markov" if self.index_dir else None
+        markov = self._load_markov(markov_dir, msg_stamp) if markov_dir else None
+        if markov is not None:
+            print(f"[brain] mapped markov snapshot from {markov_dir}", file=sys.stderr)
+        # a mapped start only reads the replies for the fallback bucket, which
+        # is not worth spawning workers for
+        workers = _build_workers() if not mapped else 1
+        pool = _build_pool(workers)
+        try:
+            if markov is None:
+                markov = _submit(pool, _timed, _train_markov, db_path, msg_mark)
+            # one pass over pairs feeds the learned fallback bucket (every
+            # reply) and, without a snapshot, retrieval (non-spam rows with a
+            # parent; chunks are cleaned in the workers). With one, only the
+            # replies are read: keys are never canonicalized
+            keys: List[str] = []
+            replies: List[str] = []
+            norms: List[str] = []
+            fallback: List[str] = []
+            t = time.perf_counter()
+            if mapped:
+                rows = self._stream(c, "SELECT reply FROM pairs WHERE reply != '' AND id <= ?", (pair_mark,))
+                for fb in _map_chunks(pool, _fallback_of, rows, window=2 * workers):
+                    fallback += [r for r in fb if hash(normalize(r)) not in recent]
+            else:
+                rows = self._stream(c, "SELECT parentKey, reply FROM pairs WHERE reply != '' AND id <= ?", (pair_mark,))
+                for ks, rs, ns, fb in _map_chunks(pool, _prep_pairs, rows, window=2 * workers):
+                    keys += ks
+                    replies += rs
+                    norms += ns
+                    fallback += [r for r in fb if hash(normalize(r)) not in recent]
+            _log_stage(f"preprocess ({workers} workers)", time.perf_counter() - t)
+            if not mapped:
+                retriever.train_clean(keys, replies, norms, pool)
+                del keys, replies, norms
+                print(f"[brain] fitted {len(retriever.keys)} pairs for retrieval", file=sys.stderr)
+                if self.index_dir:
+                    try:
+                        retriever.save(self.index_dir, stamp)
+                        snapshot = self.index_dir
+                    except OSError as e:
+                        print(f"[brain] could not write snapshot: {e}", file=sys.stderr)
+            fallback_arrays = self._fallback_arrays(fallback)
+            del fallback
+            if self.shards > 1:
+                if snapshot is not None and not mapped:
+                    # serve the fit from its snapshot: the rows the shards
+                    # copy stay file-backed here, paged in only to restart one
+                    retriever.load(snapshot, stamp)
+                _, secs = _timed(retriever.start_shards, self.shards)
+                _log_stage(f"{self.shards} retrieval shards", secs)
+            if isinstance(markov, Future):
+                markov, secs = markov.result()
+                _log_stage("markov", secs)
+                if markov_dir:
+                    try:
+                        self._save_markov(markov_dir, markov, msg_stamp)
+                    except OSError as e:
+                        print(f"[brain] could not write markov snapshot: {e}", file=sys.stderr)
+        finally:
+            if pool:
+                pool.shutdown()
         conn.close()
-        print("[brain] ready.\n", file=sys.stderr)
+        lsa = "on" if retriever.svd is not None else "off"
+        print(f"[brain] LSA semantic layer: {lsa}", file=sys.stderr)
+        print(f"[brain] trained markov on {len(markov.starters)} messages", file=sys.stderr)
+        return {
+            "retriever": retriever,
+            "markov": markov,
+            "fallback": fallback_arrays,
+            "marks": (pair_mark, msg_mark),
+            # where the retriever is saved for ``stamp``, if anywhere
+            "stamp": stamp,
+            "snapshot": snapshot,
+            "seconds": time.perf_counter() - t0,
+        }
+
+    @staticmethod
+    def _handoff(state: dict) -> dict:
+        """Write what a pre-forked worker needs to adopt a ``_build`` result
+        to a fresh temp dir: markov, fallback and, unless it is already
+        saved, the retriever snapshot. Returns the ``_adopt`` argument; the
+        dir can go once the workers have mapped it."""
+        tmp = tempfile.mkdtemp(prefix="brain-reload-")
+        snapshot = state["snapshot"]
+        if snapshot is None:
+            snapshot = os.path.join(tmp, "index")
+            state["retriever"].save(snapshot, state["stamp"])
+        state["markov"].save(os.path.join(tmp, "markov"))
+        replies, hashes, short = state["fallback"]
+        replies.save(os.path.join(tmp, "fallback"))
+        np.save(os.path.join(tmp, "fallback.hash.npy"), hashes)
+        np.save(os.path.join(tmp, "fallback.short.npy"), short)
+        return {"snapshot": snapshot, "stamp": state["stamp"], "marks": list(state["marks"]), "dir": tmp}
+
+    def _adopt(self, handoff: dict) -> dict:
+        """A ``_build`` result mapped from ``_handoff`` output: no DB reads,
+        no fit and no snapshot write in the worker, and the mapped pages are
+        shared with the other workers through the page cache."""
+        t0 = time.perf_counter()
+        live = self.retriever
+        retriever = CorpusRetriever(feature_mode=live.feature_mode, hash_buckets=live.hash_buckets)
+        if not retriever.load(handoff["snapshot"], handoff["stamp"]):
+            raise RuntimeError(f"no usable snapshot at {handoff['snapshot']}")
+        tmp = handoff["dir"]
+        return {
+            "retriever": retriever,
+            "markov": MarkovBrain.load(os.path.join(tmp, "markov")),
+            "fallback": (
+                StringArena.load(os.path.join(tmp, "fallback")),
+                np.load(os.path.join(tmp, "fallback.hash.npy"), mmap_mode="r"),
+                np.load(os.path.join(tmp, "fallback.short.npy"), mmap_mode="r"),
+            ),
+            "marks": tuple(handoff["marks"]),
+            "seconds": time.perf_counter() - t0,
+        }
+
+    def _state(self, snapshot: Optional[str], stamp: dict) -> dict:
+        """The installed set in ``_build`` form (the ``_handoff`` input)."""
+        return {
+            "retriever": self.retriever,
+            "markov": self.markov,
+            "fallback": (self._fallback_replies, self._fallback_hash, self._fallback_short),
+            "marks": (self._pair_mark, self._msg_mark),
+            "stamp": stamp,
+            "snapshot": snapshot,
+        }
+
+    def _release(self):
+        """Drop the installed set; the forked dispatcher answers nothing
+        itself, so it only holds one while building a handoff."""
+        with self._lock:
+            live = self.retriever
+            self.retriever = CorpusRetriever(feature_mode=live.feature_mode, hash_buckets=live.hash_buckets)
+            self.markov = MarkovBrain()
+            self._fallback_replies, self._fallback_hash, self._fallback_short = self._fallback_arrays([])
+            self._snapshot = (None, None)
+        live.stop_shards()
+
+    def _compacted(self, base: dict, conn: sqlite3.Connection) -> dict:
+        """``base`` (a ``_handoff``) with everything learned since ingested
+        and folded into the main segment, handed off again. Meant for the
+        forked dispatcher: the set is only resident while this runs."""
+        state = self._adopt(base)
+        with self._lock:
+            self.retriever, self.markov = state["retriever"], state["markov"]
+            self._fallback_replies, self._fallback_hash, self._fallback_short = state["fallback"]
+            self._pair_mark, self._msg_mark = state["marks"]
+        try:
+            self.ingest(conn)
+            self.compact()
+            retriever = self.retriever
+            stamp = {"max_pair_id": self._pair_mark, "pairs": len(retriever.keys), "fingerprint": retriever.fingerprint()}
+            return self._handoff(self._state(None, stamp))
+        finally:
+            self._release()
+
+    def _install(self, state: dict):
+        """Swap a ``_build`` result in under the lock: requests see either
+        the old set or the new one, never a half-trained mix."""
+        with self._lock:
+            old, self.retriever = self.retriever, state["retriever"]
+            self.markov = state["markov"]
+            self._fallback_replies, self._fallback_hash, self._fallback_short = state["fallback"]
+            # ingestion resumes from the new marks; rows it already put in
+            # the old delta segment are covered by the new build or re-read
+            self._pair_mark, self._msg_mark = state["marks"]
+            self._snapshot = state.get("snapshot"), state.get("stamp")
+        if old is not self.retriever:
+            old.stop_shards()  # waits for a lookup still using them
+        print(f"[brain] ready ({state['seconds']:.1f}s).\n", file=sys.stderr)
+
+    def corpus_size(self) -> dict:
+        with self._lock:
+            return {"pairs": len(self.retriever.keys), "messages": len(self.markov.starters)}
 
-    def _score_candidate(self, inp: str, cand: dict) -> float:
-        score = cand["sim"] * 3.1
+    def stats(self) -> dict:
+        """Stage latencies and counters since start (``STATS``), the rates
+        derived from them and the live retriever's cache."""
+        out = STATS.summary()
+        counters = out["counters"]
+
+        def rate(part: str, whole: int) -> float:
+            return round(counters.get(part, 0) / whole, 4) if whole else 0.0
+
+        lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+        out["rates"] = {
+            "fallback": rate("fallback", counters.get("replies", 0)),
+            "lsa": rate("lsa", counters.get("queries", 0)),
+            "cache_hit": rate("cache_hits", lookups),
+        }
+        out["cache"] = self.retriever.cache.stats()
+        return out
+
+    def profile(self, seconds: float, on_done: Callable[[dict], None]) -> bool:
+        """Sample the request threads for ``seconds`` on a background thread,
+        write the collapsed stacks under PROFILE_DIR and pass ``on_done`` a
+        summary (file, sample counts, hottest functions) or an error.
+        Returns False if a profile is already running."""
+        seconds = min(max(float(seconds), 0.1), PROFILE_MAX_SECONDS)
+        with self._lock:
+            if self._profiling:
+                return False
+            self._profiling = True
+        focus = [self._serve_request.__code__, self.reply.__code__, self.reply_batch.__code__]
+
+        def run():
+            try:
+                stacks, ticks = StackSampler(focus).sample(seconds)
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.collapsed")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.writelines(line + "\n" for line in StackSampler.collapsed(stacks))
+                status = {
+                    "seconds": seconds, "ticks": ticks, "samples": sum(stacks.values()),
+                    "file": path, "top": StackSampler.hottest(stacks),
+                }
+                print(f"[brain] profile of {seconds:g}s ({status['samples']} samples) written to {path}", file=sys.stderr)
+            except Exception as e:
+                status = {"error": str(e)}
+            finally:
+                with self._lock:
+                    self._profiling = False
+            on_done(status)
+
+        threading.Thread(target=run, name="brain-profile", daemon=True).start()
+        return True
+
+    def _log_stats(self, interval: float, tag: str = ""):
+        """Dump ``stats`` to stderr every ``interval`` seconds (0 = never)."""
+        if interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                print(f"[brain] stats{tag} {json.dumps(self.stats())}", file=sys.stderr)
+
+        threading.Thread(target=run, name="brain-stats", daemon=True).start()
+
+    def reload(self, db_path: str, on_done: Optional[Callable[[dict], None]] = None,
+               handoff: Optional[dict] = None) -> bool:
+        """Rebuild from the DB on a background thread while the current set
+        keeps serving, then swap it in. ``on_done`` gets a status dict
+        (seconds, old and new corpus sizes, or error). With a ``handoff``
+        the new set is mapped from it instead of built. Returns False if a
+        reload is already running."""
+        with self._lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+
+        def run():
+            status = {"old": self.corpus_size()}
+            try:
+                state = self._adopt(handoff) if handoff else self._build(db_path)
+                self._install(state)
+                status.update(seconds=round(state["seconds"], 2), new=self.corpus_size())
+            except Exception as e:
+                print(f"[brain] reload failed, still serving the old corpus: {e}", file=sys.stderr)
+                status["error"] = str(e)
+            finally:
+                with self._lock:
+                    self._reloading = False
+            if on_done is not None:
+                on_done(status)
+
+        threading.Thread(target=run, name="brain-reload", daemon=True).start()
+        return True
+
+    def _fallback_ok(self, reply: str) -> bool:
+        return normalize(reply) not in self._recent_norm and fallback_worthy(reply)
+
+    def ingest(self, conn: sqlite3.Connection) -> Tuple[int, int]:
+        """Pull pairs/messages written since the last load/ingest into the
+        live delta segment and the markov tables. Returns (pairs, messages)."""
+        c = conn.cursor()
+        marks = (self._pair_mark, self._msg_mark)
+        pairs = c.execute(
+            "SELECT id, parentKey, reply FROM pairs WHERE id > ? ORDER BY id", (marks[0],),
+        ).fetchall()
+        msgs = c.execute(
+            "SELECT rowid, content FROM messages WHERE rowid > ? ORDER BY rowid", (marks[1],),
+        ).fetchall()
+        if not pairs and not msgs:
+            return 0, 0
+        rows = [(k, r) for _, k, r in pairs if k and r and not looks_spam(r) and not looks_spam(k)]
+        messages = [m for _, m in msgs if m and not looks_spam(m)]
+        with self._lock:
+            if (self._pair_mark, self._msg_mark) != marks:
+                return 0, 0  # a reload already covered these rows
+            added = self.retriever.add([k for k, _ in rows], [r for _, r in rows])
+            self.markov.update(messages)
+            self._add_fallback([r for _, _, r in pairs if r])
+            if pairs:
+                self._pair_mark = pairs[-1][0]
+            if msgs:
+                self._msg_mark = msgs[-1][0]
+        if self.compact_delta and self.retriever.delta_rows >= DELTA_COMPACT_ROWS:
+            self.compact()
+        return added, len(messages)
+
+    def compact(self):
+        retriever = self.retriever
+        merged = retriever.merged_segments()  # the expensive part, lock-free
+        if merged is None:
+            return
+        with self._lock:
+            if self.retriever is retriever and retriever.install(merged):
+                print(f"[brain] compacted delta into main segment ({len(retriever.keys)} pairs)", file=sys.stderr)
+
+    def _ingest_loop(self, db_path: str):
+        conn = self._connect(db_path)
+        version = None
+        while True:
+            time.sleep(INGEST_INTERVAL)
+            try:
+                # data_version only moves when ANOTHER connection commits, so
+                # an idle DB costs one pragma per poll
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current == version:
+                    continue
+                version = current
+                pairs, messages = self.ingest(conn)
+                if pairs or messages:
+                    print(f"[brain] ingested {pairs} pairs, {messages} messages", file=sys.stderr)
+            except Exception as e:
+                print(f"[brain] ingest failed: {e}", file=sys.stderr)
+
+    def _msg_stamp(self, c: sqlite3.Cursor) -> dict:
+        max_rowid, count = c.execute("SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM messages").fetchone()
+        return {"max_rowid": max_rowid, "messages": count, "fingerprint": self.retriever.fingerprint()}
+
+    @staticmethod
+    def _load_markov(path: str, stamp: dict) -> Optional[MarkovBrain]:
+        """The markov snapshot at ``path`` if it was trained on ``stamp``."""
+        meta = _snapshot_meta(path)
+        if meta.get("format") != INDEX_FORMAT or meta.get("stamp") != stamp:
+            return None
+        try:
+            return MarkovBrain.load(os.path.join(path, "markov"))
+        except (OSError, ValueError) as e:
+            print(f"[brain] markov snapshot at {path} unreadable, retraining: {e}", file=sys.stderr)
+            return None
+
+    @staticmethod
+    def _save_markov(path: str, markov: MarkovBrain, stamp: dict):
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        markov.save(os.path.join(tmp, "markov"))
+        _commit_snapshot(tmp, path, {"format": INDEX_FORMAT, "stamp": stamp})
+
+    def _db_stamp(self, c: sqlite3.Cursor) -> dict:
+        # pairs are append-only from the learner; clean_corpus.py only deletes,
+        # so (max id, row count) changes whenever the retrievable set can.
+        max_id, count = c.execute("SELECT COALESCE(MAX(id), 0), COUNT(*) FROM pairs").fetchone()
+        return {"max_pair_id": max_id, "pairs": count, "fingerprint": self.retriever.fingerprint()}
+
+    def _score_candidates(self, inp: str, cands: CandidateSet, query: Optional[dict] = None) -> np.ndarray:
+        """Score every candidate at once, consensus boost included. Same
+        operations in the same order as the per-candidate formula it
+        replaced, so the scores are bit-identical to it (bench_brain.py
+        scoring keeps that formula as the reference)."""
+        # ``query`` = retriever.query_features(inp), computed once per request
+        q = query if query is not None else self.retriever.query_features(inp)
+        f = cands.features
+        recent = np.isin([hash(n) for n in cands.norms], self._recent_norm.hashes())[cands.group]
+        score = cands.sim * 3.1
         # gently discourage globally spammy replies (e.g. "lol"), but keep it
-        # light - neighbor consensus (added in _choose_reply) is what decides
-        # which genuinely-common reply is the right one for THIS input.
-        score -= math.log1p(cand["freq"]) * 0.15
+        # light - neighbor consensus (added below) is what decides which
+        # genuinely-common reply is the right one for THIS input.
+        score -= cands.log_freq * 0.15
         # heavily penalize repeats
-        if cand["reply_norm"] in self._recent_norm:
-            score -= 2.0
+        score -= np.where(recent, 2.0, 0.0)
         # parent should match the current input, not just vaguely
-        parent_overlap = lexical_overlap(inp, cand["parent"])
+        parent_overlap = PairFeatures.overlaps(f.parent_ptr, f.parent_ids, q)
         score += parent_overlap * 1.10
         # small bonus for reply lexical relation, but avoid parroting
-        reply_overlap = lexical_overlap(inp, cand["reply"])
+        reply_overlap = PairFeatures.overlaps(f.reply_ptr, f.reply_ids, q)
         score += reply_overlap * 0.18
-        if reply_overlap > 0.75:
-            score -= 0.9
-        if looks_generic(cand["reply"]):
-            score -= 0.85
-        in_len = len(tokenize(inp))
-        out_len = len(tokenize(cand["reply"]))
-        inp_is_q = is_question(inp)
-        parent_is_q = is_question(cand["parent"])
-        if inp_is_q and parent_is_q:
-            score += 0.25
-        if inp_is_q and out_len <= 1:
-            score -= 0.30
+        score -= np.where(reply_overlap > 0.75, 0.9, 0.0)
+        score -= np.where(f.reply_generic, 0.85, 0.0)
+        in_len = q["len"]
+        out_len = f.reply_len
+        if q["question"]:
+            score += np.where(f.parent_question, 0.25, 0.0)
+            score -= np.where(out_len <= 1, 0.30, 0.0)
         # short user input should not get essay replies
-        if in_len <= 3 and out_len > 10:
-            score -= 0.55
+        if in_len <= 3:
+            score -= np.where(out_len > 10, 0.55, 0.0)
         # long user input should not get ultra-short throwaways
-        if in_len >= 8 and out_len <= 1:
-            score -= 0.45
+        if in_len >= 8:
+            score -= np.where(out_len <= 1, 0.45, 0.0)
         # giant lore dumps are rarely good
-        if out_len >= 28:
-            score -= 0.35
-        return score
+        score -= np.where(out_len >= 28, 0.35, 0.0)
+        return score + CONSENSUS_WEIGHT * cands.log_consensus
 
-    def _choose_reply(self, text: str, context: Optional[List[str]] = None) -> Tuple[Optional[str], float]:
-        cands = self.retriever.top_candidates(text, context=context, limit=40)
-        if not cands:
-            return None, -999.0
+    def _pick(self, text: str, cands: Optional[CandidateSet]) -> Tuple[Optional[str], float]:
         # Reply-space consensus: how strongly the retrieved neighbourhood
         # agrees on an answer (similarity-weighted, near-duplicates included).
         # The reply the crowd converges on gets boosted; one-off noise doesn't.
-        consensus = self.retriever.reply_consensus(cands)
-        scored = [
-            (self._score_candidate(text, c) + CONSENSUS_WEIGHT * math.log1p(max(0.0, consensus[k])), c)
-            for k, c in enumerate(cands)
-        ]
-        scored.sort(key=lambda x: x[0], reverse=True)
-        # dedupe by normalized reply first
-        unique = []
-        seen = set()
-        for s, c in scored:
-            nr = c["reply_norm"]
-            if nr in seen:
-                continue
-            seen.add(nr)
-            unique.append((s, c))
-        if not unique:
+        if cands is None:
             return None, -999.0
+        scores = self._score_candidates(text, cands)
+        # stable, so equal scores keep retrieval order
+        order = np.argsort(-scores, kind="stable")
+        # dedupe by normalized reply first (its best-scoring copy survives)
+        _, first = np.unique(cands.group[order], return_index=True)
+        unique = order[np.sort(first)]
+        groups = cands.group[unique]
         # Discourage repetition HARD: drop replies used in the recent window
         # entirely (the consensus boost otherwise keeps re-picking the same
         # top reply). Only relax this if it would leave us with nothing.
-        fresh = [(s, c) for s, c in unique if c["reply_norm"] not in self._recent_norm]
-        if fresh:
-            pool = fresh
+        recent = np.isin([hash(n) for n in cands.norms], self._recent_norm.hashes())[groups]
+        if not recent.all():
+            pool = unique[~recent]
         else:
             # everything was used recently; at least never repeat back-to-back
-            last = self._recent_norm[-1] if self._recent_norm else None
-            relaxed = [(s, c) for s, c in unique if c["reply_norm"] != last]
-            pool = relaxed if relaxed else unique
-        best_score = pool[0][0]
+            last = self._recent_norm.last()
+            relaxed = np.array([hash(n) != last for n in cands.norms], dtype=bool)[groups]
+            pool = unique[relaxed] if relaxed.any() else unique
+        pool_scores = scores[pool]
+        best_score = float(pool_scores[0])
         # genuinely nothing relevant -> caller uses the learned fallback bucket
         if best_score < MIN_RELEVANT_SCORE:
             return None, best_score
         # Many equally-good replies is the BEST case for a chat bot, not
         # ambiguity. Shortlist the near-best candidates and pick one at
         # weighted random: stays on-topic, but not robotically repetitive.
-        shortlist = [(s, c) for s, c in pool if s >= best_score - SHORTLIST_WINDOW and s > 0.15][:6]
-        weights = [max(0.05, s) for s, _ in shortlist]
-        idx = random.choices(range(len(shortlist)), weights=weights, k=1)[0]
-        picked_score, picked = shortlist[idx]
-        return picked["reply"], picked_score
+        near = (pool_scores >= best_score - SHORTLIST_WINDOW) & (pool_scores > 0.15)
+        shortlist = pool[near][:6]
+        weights = [max(0.05, s) for s in scores[shortlist].tolist()]
+        pick = shortlist[random.choices(range(len(shortlist)), weights=weights, k=1)[0]]
+        return self.retriever.replies[int(cands.idx[pick])], float(scores[pick])
 
     def _mutate_reply(self, base_reply: str, user_text: str) -> str:
         user_len = len(tokenize(user_text))
@@ -574,38 +2977,38 @@ class HopfiBrain:
         return base_reply
 
     def _quality_ok(self, text: str) -> bool:
-        nt = normalize(text)
-        toks = tokenize(nt)
-        if not nt:
-            return False
-        if looks_spam(text):
-            return False
-        if nt in self._recent_norm:
-            return False
-        if len(toks) < 1 or len(toks) > 18:
-            return False
-        counts = Counter(toks)
-        if max(counts.values(), default=0) >= 3:
-            return False
-        if len(toks) >= 4 and len(set(toks)) / max(1, len(toks)) < 0.40:
-            return False
-        one_char = sum(1 for t in toks if len(t) == 1)
-        if one_char >= max(3, len(toks) // 2):
-            return False
-        for i in range(len(toks) - 2):
-            if toks[i] == toks[i + 1] == toks[i + 2]:
-                return False
-        return True
+        return normalize(text) not in self._recent_norm and reply_quality_ok(text)
+
+    @staticmethod
+    def _fallback_arrays(ok: List[str]) -> Tuple[StringArena, np.ndarray, np.ndarray]:
+        """Fallback bucket for ``ok`` (already ``_fallback_ok``): the arena,
+        hash(normalize(reply)) and the is-short flags."""
+        return (
+            StringArena.from_strings(ok),
+            np.array([hash(normalize(r)) for r in ok], dtype=np.int64),
+            np.array([len(tokenize(r)) <= 6 for r in ok], dtype=bool),
+        )
+
+    def _add_fallback(self, replies: List[str]):
+        ok = [r for r in replies if self._fallback_ok(r)]
+        self._fallback_replies.extend(ok)
+        self._fallback_hash = np.concatenate([
+            self._fallback_hash, np.array([hash(normalize(r)) for r in ok], dtype=np.int64),
+        ])
+        self._fallback_short = np.concatenate([
+            self._fallback_short, np.array([len(tokenize(r)) <= 6 for r in ok], dtype=bool),
+        ])
 
     def _fallback_reply(self, text: str) -> str:
         inp_is_q = is_question(text)
-        pool = [r for r in self._fallback_replies if normalize(r) not in self._recent_norm]
+        recent = self._recent_norm.hashes()
+        pool = np.flatnonzero(~np.isin(self._fallback_hash, recent))
         if inp_is_q:
-            qish = [r for r in pool if len(tokenize(r)) <= 6]
-            if qish:
+            qish = pool[self._fallback_short[pool]]
+            if qish.size:
                 pool = qish
-        if pool:
-            return random.choice(pool)
+        if pool.size:
+            return self._fallback_replies[random.choice(pool)]
         # very last resort only
         for _ in range(4):
             gen = self.markov.generate(seed=text, max_words=10)
@@ -615,14 +3018,41 @@ class HopfiBrain:
 
     def reply(self, text: str, context: Optional[List[str]] = None) -> str:
         context = context or []
-        hit, score = self._choose_reply(text, context=context)
+        t0 = time.perf_counter()
+        cands = self.retriever.lookup(text, context=context, limit=CANDIDATE_LIMIT)
+        STATS.lap("retrieve", t0)
+        raw = self._respond(text, cands)
+        STATS.lap("reply", t0)
+        return raw
+
+    def reply_batch(self, requests: List[Tuple[str, Optional[List[str]]]]) -> List[str]:
+        """``reply`` for a burst of (text, context) requests. Retrieval runs
+        once for the whole batch; picking then goes request by request, so
+        the anti-repeat window sees each answer before the next pick, exactly
+        as if they had arrived one at a time."""
+        t0 = time.perf_counter()
+        found = self.retriever.lookup_batch([(text, context or []) for text, context in requests], limit=CANDIDATE_LIMIT)
+        STATS.lap("retrieve_batch", t0)
+        out = [self._respond(text, cands) for (text, _), cands in zip(requests, found)]
+        STATS.lap("reply_batch", t0)
+        return out
+
+    def _respond(self, text: str, cands: Optional[CandidateSet]) -> str:
+        t = time.perf_counter()
+        hit, score = self._pick(text, cands)
+        t = STATS.lap("scoring", t)
+        STATS.count("replies")
         if hit is not None:
             candidate = hit
             if score < MUTATE_BELOW_SCORE and self._quality_ok(candidate):
                 candidate = self._mutate_reply(candidate, text)
+                t = STATS.lap("mutate", t)
         else:
+            STATS.count("fallback")
             candidate = self._fallback_reply(text)
+            t = STATS.lap("fallback", t)
         raw = self.emojis.resolve(candidate)
+        STATS.lap("emoji", t)
         # never hand back an empty string - Discord rejects empty replies,
         # and emoji-only candidates can resolve to nothing.
         if not raw.strip():
@@ -635,27 +3065,447 @@ class HopfiBrain:
         self._recent_norm.append(normalize(candidate))
         return raw
 
-    def serve(self):
+    def serve(self, workers: int = SERVE_WORKERS, stats_every: float = STATS_LOG_INTERVAL):
         sys.stdout.reconfigure(encoding="utf-8", errors="replace")
         sys.stdin.reconfigure(encoding="utf-8", errors="replace")
+        if workers > 1 and hasattr(os, "fork"):
+            self._serve_forked(workers, stats_every)
+            return
+        if INGEST_INTERVAL > 0:
+            threading.Thread(target=self._ingest_loop, args=(DB_PATH,), daemon=True).start()
+        self._log_stats(stats_every)
+        out = threading.Lock()  # workers and the reload thread answer too
+        workers = ThreadPoolExecutor(max_workers=SERVE_THREADS, thread_name_prefix="brain-serve")
+
+        def send(msg: dict):
+            with out:
+                print(json.dumps(msg), flush=True)
+
+        def run(req, respond: Callable[[dict], None]):
+            try:
+                self._serve_request(req, respond)
+            except Exception as e:
+                respond({"ok": False, "error": str(e)})
+
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                req = json.loads(line)
+            except ValueError as e:
+                send({"ok": False, "error": str(e)})
+                continue
+            rid = req.get("id") if isinstance(req, dict) else None
+            if rid is None:
+                # untagged requests are answered in order, one at a time
+                run(req, send)
+                continue
+
+            def respond(msg: dict, rid=rid):
+                send({"id": rid, **msg})
+
+            workers.submit(run, req, respond)
+
+    def _serve_request(self, req: dict, respond: Callable[[dict], None]):
+        """Answer one ``serve`` request through ``respond``, which tags the
+        answer with the request id (if any). A reload answers later, from
+        its own thread, once the new corpus is swapped in."""
+        if req.get("stats"):
+            respond({"ok": True, "stats": self.stats()})
+            return
+        if req.get("profile"):
+            def profiled(status: dict):
+                if "error" in status:
+                    respond({"ok": False, "error": status["error"], "profile": status})
+                else:
+                    respond({"ok": True, "profile": status})
+
+            options = req["profile"] if isinstance(req["profile"], dict) else {}
+            # answered once the window is over; replies keep flowing meanwhile
+            if not self.profile(options.get("seconds", 10), on_done=profiled):
+                respond({"ok": False, "error": "profile already running", "profile": {"running": True}})
+            return
+        if req.get("reload"):
+            def reloaded(status: dict):
+                if "error" in status:
+                    respond({"ok": False, "error": status["error"], "reload": status})
+                else:
+                    respond({"ok": True, "result": "reloaded", "reload": status})
+
+            # built in the background; replies keep flowing meanwhile
+            if not self.reload(DB_PATH, on_done=reloaded, handoff=req.get("handoff")):
+                respond({"ok": False, "error": "reload already running", "reload": {"running": True}})
+            return
+        if "batch" in req:
+            batch = [self._request_args(item) for item in req["batch"] or []]
+            with self._lock:
+                result = self.reply_batch(batch)
+            respond({"ok": True, "result": result})
+            return
+        text, context = self._request_args(req)
+        with self._lock:
+            result = self.reply(text, context=context)
+        respond({"ok": True, "result": result})
+
+    def _serve_forked(self, n: int, stats_every: float = STATS_LOG_INTERVAL):
+        """``serve`` over ``n`` forked workers. Each request goes to the
+        least busy worker; answers are relayed back as they come, tagged
+        like in ``serve``. The dispatcher keeps no corpus resident: it holds
+        what the workers run as a handoff, and a reload (or a compaction of
+        what the workers ingested since) is built here once from the DB (or
+        that handoff), then every worker maps it (no N-fold rebuild)."""
+        ctx = multiprocessing.get_context("fork")
+        # workers search in-process: forked copies can't share shard pipes
+        self.shards = 1
+        self.retriever.stop_shards()
+        # fork before any thread starts here; the window goes shared first
+        shared = RecentWindow.shared(self._recent_norm.maxlen, ctx)
+        shared.reset(self._recent_norm.hashes())
+        self._recent_norm = shared
+        conns = []
+        for i in range(n):
+            conn, child = ctx.Pipe()
+            ctx.Process(target=self._serve_worker, args=(child, stats_every), name=f"brain-worker-{i}", daemon=True).start()
+            child.close()
+            conns.append(conn)
+        print(f"[brain] serving on {n} forked workers", file=sys.stderr)
+        # the workers' set, as the dispatcher's own copy of it goes
+        base = self._handoff(self._state(*self._snapshot))
+        self._release()
+        rebuilding = threading.Lock()  # one reload or compaction at a time
+        out = threading.Lock()
+        routes_lock = threading.Lock()
+        routes: Dict[int, Tuple[int, Callable[[dict], None]]] = {}  # token -> (worker, callback)
+        busy = [0] * n
+        tokens = iter(range(1, 2 ** 62))
+
+        def send(msg: dict):
+            with out:
+                print(json.dumps(msg), flush=True)
+
+        def dispatch(worker: int, req: dict, callback: Callable[[dict], None]):
+            with routes_lock:
+                token = next(tokens)
+                routes[token] = (worker, callback)
+                busy[worker] += 1
+            try:
+                conns[worker].send((token, req))
+            except (OSError, ValueError) as e:
+                with routes_lock:
+                    routes.pop(token, None)
+                    busy[worker] -= 1
+                callback({"ok": False, "error": f"worker {worker} unavailable: {e}"})
+
+        def relay():
+            live = list(conns)
+            while live:
+                try:
+                    ready = wait_connections(live)
+                except OSError:
+                    return  # stdin closed, conns torn down
+                for conn in ready:
+                    worker = conns.index(conn)
+                    try:
+                        token, msg = conn.recv()
+                    except (EOFError, OSError):
+                        live.remove(conn)
+                        print(f"[brain] worker {worker} exited", file=sys.stderr)
+                        with routes_lock:
+                            busy[worker] = 2 ** 62  # never picked again
+                            lost = [t for t, (w, _) in routes.items() if w == worker]
+                            callbacks = [routes.pop(t)[1] for t in lost]
+                        for callback in callbacks:
+                            callback({"ok": False, "error": f"worker {worker} exited"})
+                        continue
+                    with routes_lock:
+                        _, callback = routes.pop(token)
+                        busy[worker] -= 1
+                    callback(msg)
+
+        def gather(req: dict, done: Callable[[List[dict]], None]):
+            """Send ``req`` to every worker; ``done`` gets the answers (in
+            worker order) from the relay thread once the last one is in."""
+            answers: List[Optional[dict]] = [None] * n
+            left = [n]
+
+            def collect(msg: dict, worker: int):
+                with routes_lock:
+                    answers[worker] = msg
+                    left[0] -= 1
+                    finished = left[0] == 0
+                if finished:
+                    done(answers)
+
+            for worker in range(n):
+                dispatch(worker, req, lambda msg, worker=worker: collect(msg, worker))
+
+        def broadcast(req: dict) -> List[dict]:
+            # for the reload/compaction threads, which can afford to wait
+            answers: List[dict] = []
+            done = threading.Event()
+
+            def finish(got: List[dict]):
+                answers.extend(got)
+                done.set()
+
+            gather(req, finish)
+            done.wait()
+            return answers
+
+        def hand_off(handoff: dict) -> List[dict]:
+            # every worker maps the new set; then it is the base, and the
+            # previous one's files can go (mapped pages outlive the unlink)
+            nonlocal base
+            answers = broadcast({"reload": True, "handoff": handoff})
+            old, base = base, handoff
+            shutil.rmtree(old["dir"], ignore_errors=True)
+            return answers
+
+        def reload_all(respond: Callable[[dict], None]):
+            # built once here, then every worker maps the result; the build
+            # is dropped here afterwards (the dispatcher doesn't answer)
+            t0 = time.perf_counter()
+            with rebuilding:
+                try:
+                    handoff = self._handoff(self._build(DB_PATH))
+                except Exception as e:
+                    self._reloading = False
+                    print(f"[brain] reload failed, workers keep the old corpus: {e}", file=sys.stderr)
+                    respond({"ok": False, "error": str(e), "reload": {"error": str(e)}})
+                    return
+                answers = hand_off(handoff)
+            self._reloading = False
+            failed = [a for a in answers if not a.get("ok")]
+            status = dict(next((a.get("reload") for a in answers if a.get("ok")), None) or {})
+            status.update(seconds=round(time.perf_counter() - t0, 2), workers=n - len(failed))
+            if failed:
+                respond({"ok": False, "error": failed[0].get("error"), "reload": status})
+            else:
+                respond({"ok": True, "result": "reloaded", "reload": status})
+
+        def compact_all():
+            # workers keep what they ingest in their delta segment; once that
+            # is about DELTA_COMPACT_ROWS pairs, it is folded in here and the
+            # result handed to all of them (which also empties their deltas)
+            conn = self._connect(DB_PATH)
+            while True:
+                time.sleep(INGEST_INTERVAL)
+                try:
+                    mark = base["marks"][0]
+                    fresh = conn.execute("SELECT COUNT(*) FROM pairs WHERE id > ?", (mark,)).fetchone()[0]
+                    if fresh < DELTA_COMPACT_ROWS:
+                        continue
+                    with rebuilding:
+                        if base["marks"][0] != mark:
+                            continue  # a reload got there first
+                        t0 = time.perf_counter()
+                        answers = hand_off(self._compacted(base, conn))
+                    failed = sum(1 for a in answers if not a.get("ok"))
+                    print(f"[brain] compacted {fresh} new pairs for {n - failed} workers "
+                          f"({time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+                except Exception as e:
+                    print(f"[brain] compaction failed, workers keep their delta: {e}", file=sys.stderr)
+
+        threading.Thread(target=relay, name="brain-relay", daemon=True).start()
+        if INGEST_INTERVAL > 0:
+            threading.Thread(target=compact_all, name="brain-compact", daemon=True).start()
         for line in sys.stdin:
             line = line.strip()
             if not line:
                 continue
             try:
                 req = json.loads(line)
-                if req.get("reload"):
-                    self._load(DB_PATH)
-                    print(json.dumps({"ok": True, "result": "reloaded"}), flush=True)
+            except ValueError as e:
+                send({"ok": False, "error": str(e)})
+                continue
+            rid = req.get("id") if isinstance(req, dict) else None
+            # untagged requests are answered in order, one at a time
+            answered = threading.Event()
+
+            def respond(msg: dict, rid=rid, answered=answered):
+                send(msg if rid is None else {"id": rid, **msg})
+                answered.set()
+
+            if isinstance(req, dict) and req.get("reload"):
+                if self._reloading:
+                    respond({"ok": False, "error": "reload already running", "reload": {"running": True}})
+                else:
+                    self._reloading = True
+                    threading.Thread(target=reload_all, args=(respond,), name="brain-reload", daemon=True).start()
+                continue  # answered later, as in ``serve``
+            if isinstance(req, dict) and req.get("stats"):
+                # every worker keeps its own
+                def stats_done(answers: List[dict], respond=respond):
+                    respond({"ok": True, "stats": {"workers": [a.get("stats") for a in answers]}})
+
+                gather({"stats": True}, stats_done)
+            elif isinstance(req, dict) and req.get("profile"):
+                if self._profiling:
+                    respond({"ok": False, "error": "profile already running", "profile": {"running": True}})
                     continue
-                text = req.get("text", "") or ""
-                context = req.get("context", []) or []
-                if not isinstance(context, list):
-                    context = []
-                result = self.reply(text, context=context)
-                print(json.dumps({"ok": True, "result": result}), flush=True)
+                self._profiling = True
+
+                # every worker samples (and writes) its own stacks
+                def profiled(answers: List[dict], respond=respond):
+                    self._profiling = False
+                    failed = [a for a in answers if not a.get("ok")]
+                    if failed:
+                        respond({"ok": False, "error": failed[0].get("error"), "profile": {"workers": [a.get("profile") for a in answers]}})
+                    else:
+                        respond({"ok": True, "profile": {"workers": [a["profile"] for a in answers]}})
+
+                gather(req, profiled)
+                continue  # answered once the window is over, as in ``serve``
+            else:
+                with routes_lock:
+                    worker = busy.index(min(busy))
+                dispatch(worker, req, respond)
+            if rid is None:
+                answered.wait()
+        for conn in conns:
+            conn.close()
+        shutil.rmtree(base["dir"], ignore_errors=True)
+
+    def _serve_worker(self, conn, stats_every: float = STATS_LOG_INTERVAL):
+        """Body of a forked serve worker: answer (token, request) pairs from
+        the dispatcher. Reload answers come later, from the reload thread."""
+        random.seed()  # otherwise every worker replays the parent's stream
+        self.compact_delta = False
+        # reloads come as a handoff from the dispatcher; a worker never
+        # builds, so it never writes the shared snapshot either
+        self.index_dir = None
+        if INGEST_INTERVAL > 0:
+            threading.Thread(target=self._ingest_loop, args=(DB_PATH,), daemon=True).start()
+        self._log_stats(stats_every, f" (worker {os.getpid()})")
+        sending = threading.Lock()
+        while True:
+            try:
+                token, req = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            def respond(msg: dict, token=token):
+                with sending:
+                    conn.send((token, msg))
+
+            try:
+                self._serve_request(req, respond)
             except Exception as e:
-                print(json.dumps({"ok": False, "error": str(e)}), flush=True)
+                respond({"ok": False, "error": str(e)})
+
+    def listen(self, address: str, stats_every: float = STATS_LOG_INTERVAL):
+        """Serve the ``serve`` protocol (JSON lines, optional per-request
+        ids) on a Unix socket, to any number of concurrent clients: bot
+        shards, an admin shell (``socat - UNIX-CONNECT:/path``), the
+        evaluator. Ids only need to be unique within a connection."""
+        if not address.startswith("unix:"):
+            raise ValueError(f"unsupported listen address {address!r} (expected unix:/path)")
+        self._log_stats(stats_every)
+        try:
+            asyncio.run(self._listen(address[len("unix:"):]))
+        except asyncio.CancelledError:
+            pass  # SIGTERM
+
+    async def _listen(self, path: str):
+        loop = asyncio.get_running_loop()
+        # retrieval is CPU-bound; it runs here, off the event loop
+        executor = ThreadPoolExecutor(max_workers=SERVE_THREADS, thread_name_prefix="brain-listen")
+        if INGEST_INTERVAL > 0:
+            threading.Thread(target=self._ingest_loop, args=(DB_PATH,), daemon=True).start()
+
+        async def answer(req) -> dict:
+            done = loop.create_future()
+
+            def respond(msg: dict):
+                # may come from a worker thread or, for a reload, later on
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(msg))
+
+            def run():
+                try:
+                    self._serve_request(req, respond)
+                except Exception as e:
+                    respond({"ok": False, "error": str(e)})
+
+            await loop.run_in_executor(executor, run)
+            return await done
+
+        async def client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            inflight = asyncio.Semaphore(LISTEN_MAX_INFLIGHT)
+            writing = asyncio.Lock()
+            tasks = set()
+
+            async def send(msg: dict):
+                async with writing:
+                    writer.write((json.dumps(msg) + "\n").encode("utf-8"))
+                    # a client that doesn't read its answers stalls only itself
+                    await writer.drain()
+
+            async def reply(req, rid):
+                try:
+                    msg = await answer(req)
+                    await send(msg if rid is None else {"id": rid, **msg})
+                finally:
+                    inflight.release()
+
+            try:
+                while True:
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        await send({"ok": False, "error": f"request line over {LISTEN_LINE_LIMIT} bytes"})
+                        break
+                    if not line:
+                        break
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        req = json.loads(line)
+                    except ValueError as e:
+                        await send({"ok": False, "error": str(e)})
+                        continue
+                    rid = req.get("id") if isinstance(req, dict) else None
+                    # backpressure: stop reading while this many are pending
+                    await inflight.acquire()
+                    # a reload or profile answers when it is over, as in
+                    # ``serve``; reads go on meanwhile, tagged or not
+                    later = isinstance(req, dict) and bool(req.get("reload") or req.get("profile"))
+                    if rid is None and not later:
+                        # untagged requests are answered in order, one at a time
+                        await reply(req, rid)
+                        continue
+                    task = asyncio.create_task(reply(req, rid))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                writer.close()
+
+        if os.path.exists(path):
+            os.unlink(path)  # stale socket from an earlier run
+        server = await asyncio.start_unix_server(client, path=path, limit=LISTEN_LINE_LIMIT)
+        # shut down (and remove the socket) on SIGTERM too, not just ctrl+c
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        print(f"[brain] listening on unix:{path}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _request_args(req: dict) -> Tuple[str, List[str]]:
+        text = req.get("text", "") or ""
+        context = req.get("context", []) or []
+        if not isinstance(context, list):
+            context = []
+        return text, context
 
     def chat(self):
         sys.stdout.reconfigure(encoding="utf-8", errors="replace")
@@ -670,8 +3520,26 @@ class HopfiBrain:
             print("\nbye!")
 
 if __name__ == "__main__":
-    bot = HopfiBrain()
-    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
-        bot.serve()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--serve", action="store_true", help="JSON-lines server on stdin/stdout (default: interactive chat)")
+    ap.add_argument("--workers", type=int, default=SERVE_WORKERS, help="forked serve processes sharing one loaded index")
+    ap.add_argument("--listen", metavar="unix:/path", help="serve the same protocol on a Unix socket instead")
+    ap.add_argument("--shards", type=int, default=RETRIEVAL_SHARDS, help="retrieval shard processes per lookup "
+                    "(each copies its rows of the index; the parent keeps them mapped from the snapshot)")
+    ap.add_argument("--stats-every", type=float, default=STATS_LOG_INTERVAL, metavar="SECONDS", help="dump stage latency stats to stderr")
+    ap.add_argument("--compact", action="store_true", default=COMPACT_MATRICES,
+                    help="fit float32/int32 matrices (about half the memory, similarities differ in the 7th digit)")
+    args = ap.parse_args()
+    COMPACT_MATRICES = args.compact
+    if args.shards > 1 and args.workers > 1:
+        ap.error("--shards and --workers are exclusive")
+    bot = HopfiBrain(shards=args.shards)
+    if args.listen:
+        try:
+            bot.listen(args.listen, stats_every=args.stats_every)
+        except KeyboardInterrupt:
+            pass
+    elif args.serve:
+        bot.serve(workers=args.workers, stats_every=args.stats_every)
     else:
         bot.chat()
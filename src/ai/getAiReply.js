@@ -20,15 +20,23 @@ export class PythonAIWorker {
     #proc = null;
     /** @type {boolean} */
     #ready;
+    /** @type {Map<number, { resolve: (msg: any) => void, reject: (err: Error) => void }>} */
+    #pending = new Map();
+    /** @type {number} */
+    #nextId = 0;
+    /** @type {string} */
+    #buffer = "";
 
     /**
      * Creates an instance of PythonAIWorker.
      *
      * @param {string} [scriptPath="./src/ai/brain.py"]
+     * @param {number} [workers=1] forked Python processes sharing one loaded index
      * @memberof PythonAIWorker
      */
-    constructor(scriptPath = "./src/ai/brain.py"){
+    constructor(scriptPath = "./src/ai/brain.py", workers = 1){
         this.scriptPath = scriptPath;
+        this.workers = workers;
         this.#ready = false;
         this.#start();
     }
@@ -63,7 +71,7 @@ export class PythonAIWorker {
      * @memberof PythonAIWorker
      */
     #start(){
-        this.#proc = spawn(this.#getPyPath(), [this.scriptPath, "--serve"], {
+        this.#proc = spawn(this.#getPyPath(), [this.scriptPath, "--serve", "--workers", String(this.workers)], {
             stdio: ["pipe", "pipe", "inherit"], // stdin, stdout, stderr
         });
 
@@ -73,6 +81,15 @@ export class PythonAIWorker {
         });
 
         this.#proc.stdout?.setEncoding("utf8");
+        this.#buffer = "";
+
+        // one listener for all requests; a chunk may hold several lines or
+        // end mid-line
+        this.#proc.stdout?.on("data", (/** @type {string} */ data) => {
+            const lines = (this.#buffer + data).split("\n");
+            this.#buffer = lines.pop() ?? "";
+            for (const line of lines) this.#onLine(line);
+        });
 
         // @ts-ignore
         this.#proc.on("error", (/** @type {Error} */ err) => {
@@ -83,12 +100,58 @@ export class PythonAIWorker {
         this.#proc.on("exit", (/** @type {any} */ code, /** @type {any} */ signal) => {
             Log.warn(`[AIWorker] Python process exited with code=${code} signal=${signal}`);
             this.#ready = false;
+            for (const { reject } of this.#pending.values()) reject(new Error("Python worker exited"));
+            this.#pending.clear();
             // setTimeout(() => this.#start(), 2000);
         });
 
         this.#ready = true;
     }
 
+    /**
+     * Route one stdout line to the request it answers, by id.
+     *
+     * @param {string} line
+     * @memberof PythonAIWorker
+     */
+    #onLine(line){
+        if (!line.trim()) return;
+        let msg;
+        try {
+            msg = JSON.parse(line);
+        }
+        catch (e){
+            Log.warn("[AIWorker] Unparseable worker output (" + e + "): " + line);
+            return;
+        }
+        const pending = this.#pending.get(msg.id);
+        if (!pending){
+            Log.warn("[AIWorker] Response for unknown request id " + msg.id + ": " + (msg.error || msg.result));
+            return;
+        }
+        this.#pending.delete(msg.id);
+        if (msg.ok) pending.resolve(msg);
+        else pending.reject(new Error(msg.error));
+    }
+
+    /**
+     * Send a request tagged with a fresh id. Any number can be in flight;
+     * the worker answers them in whatever order they finish.
+     *
+     * @param {Object} payload
+     * @return {Promise<any>} the worker's response object
+     * @memberof PythonAIWorker
+     */
+    #request(payload){
+        if (!this.#ready) return Promise.reject(new Error("Python worker not running"));
+
+        return new Promise((resolve, reject) => {
+            const id = ++this.#nextId;
+            this.#pending.set(id, { resolve, reject });
+            this.#proc?.stdin?.write(JSON.stringify({ id, ...payload }) + "\n");
+        });
+    }
+
     /**
      * Send text to the Python process for inference and get the response.
      *
@@ -97,56 +160,51 @@ export class PythonAIWorker {
      * @return {Promise<string>}
      * @memberof PythonAIWorker
      */
-    infer(text, context = []){
-        if (!this.#ready) return Promise.reject(new Error("Python worker not running"));
+    async infer(text, context = []){
+        const msg = await this.#request({ text, context });
+        Log.debug("[AIWorker] Inference request: '" + text + "'");
+        Log.debug("[AIWorker] Inference response: '" + msg.result + "'");
+        return msg.result.trim();
+    }
 
-        return new Promise((resolve, reject) => {
-            const req = JSON.stringify({ text, context }) + "\n";
-            this.#proc?.stdin?.write(req);
-
-            const onData = (/** @type {string} */ data) => {
-                try {
-                    const msg = JSON.parse(data.toString());
-                    if (msg.ok){
-                        Log.debug("[AIWorker] Inference request: '" + text + "'");
-                        Log.debug("[AIWorker] Inference response: '" + msg.result + "'");
-                        resolve(msg.result.trim());
-                    }
-                    else reject(new Error(msg.error));
-                }
-                catch (e){
-                    reject(e);
-                }
-                finally {
-                    this.#proc?.stdout?.off("data", onData);
-                }
-            };
-
-            this.#proc?.stdout?.on("data", onData);
-        });
+    /**
+     * Rebuild the brain from the DB. The worker keeps answering infer()
+     * calls while it builds and swaps the new corpus in when done.
+     *
+     * @return {Promise<void>}
+     * @memberof PythonAIWorker
+     */
+    async reload(){
+        const msg = await this.#request({ reload: true });
+        const { seconds, old, new: now } = msg.reload;
+        Log.done(`[AIWorker] Brain reloaded from DB in ${seconds}s (pairs ${old.pairs} -> ${now.pairs}, messages ${old.messages} -> ${now.messages}).`);
     }
 
-    reload(){
-        if (!this.#ready) return Promise.reject(new Error("Python worker not running"));
+    /**
+     * Per-stage reply latencies (p50/p95/p99 in ms) and counters of the
+     * brain (one entry per worker when it serves pre-forked).
+     *
+     * @return {Promise<Object>}
+     * @memberof PythonAIWorker
+     */
+    async stats(){
+        const msg = await this.#request({ stats: true });
+        return msg.stats;
+    }
 
-        return /** @type {Promise<void>} */ (new Promise((resolve, reject) => {
-            this.#proc?.stdin?.write(JSON.stringify({ reload: true }) + "\n");
-
-            const onData = (/** @type {string} */ data) => {
-                try {
-                    const msg = JSON.parse(data.toString());
-                    if (msg.ok){
-                        Log.done("[AIWorker] Brain reloaded from DB.");
-                        resolve();
-                    }
-                    else reject(new Error(msg.error));
-                }
-                catch (e){ reject(e); }
-                finally { this.#proc?.stdout?.off("data", onData); }
-            };
-
-            this.#proc?.stdout?.on("data", onData);
-        }));
+    /**
+     * Sample the brain's request threads for a while under live traffic.
+     * Resolves once the window is over with the collapsed-stack file and
+     * the hottest functions.
+     *
+     * @param {number} [seconds]
+     * @return {Promise<Object>}
+     * @memberof PythonAIWorker
+     */
+    async profile(seconds = 10){
+        const msg = await this.#request({ profile: { seconds } });
+        Log.info(`[AIWorker] Brain profile written (${seconds}s of traffic).`);
+        return msg.profile;
     }
 
     stop(){